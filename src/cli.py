@@ -17,8 +17,13 @@ from lm_quant_toolkit.eval.bench import (
 from lm_quant_toolkit.eval.bench_vit import ALL_MODELS as ALL_VIT_MODELS
 from lm_quant_toolkit.eval.bench_vit import MXQ_CONFIGS as VIT_MXQ_CONFIGS
 from lm_quant_toolkit.eval.bench_vit import do_expermient as do_expermient_vit
-from lm_quant_toolkit.eval.common import HQQ_CONFIGS
-from lm_quant_toolkit.misc.quant_sim import dump_mxq_configs, dump_mxq_objectives
+from lm_quant_toolkit.eval.common import HQQ_CONFIGS, combine_metrics
+from lm_quant_toolkit.misc.allocator import ALLOCATORS, check_allocator_options
+from lm_quant_toolkit.misc.quant_sim import (
+    dump_mxq_configs,
+    dump_mxq_frontier,
+    dump_mxq_objectives,
+)
 from lm_quant_toolkit.misc.qweight import dump_quant_allocation
 
 
@@ -64,14 +69,15 @@ def get_parser_args():
     parser_llm.add_argument(
         "--task",
         type=str,
-        default=None,
+        default=["quant"],
+        nargs="+",
         choices=[
             "quant",
             "eval_model_storage",
             "eval_ppl",
             "eval_leaderboard",
         ],
-        help="Task to evaluate on.",
+        help="Task(s) to evaluate on, all tasks of a model config share one load.",
     )
 
     parser_llm.add_argument(
@@ -81,6 +87,22 @@ def get_parser_args():
         help="Whether to dump CUDA memory snapshot",
     )
 
+    parser_llm.add_argument(
+        "--devices",
+        default=None,
+        type=str,
+        nargs="+",
+        help="Run sub-tasks on worker processes bound to these devices, "
+        "e.g. cuda:0 cuda:1 cpu. Runs serially in-process if omitted",
+    )
+
+    parser_llm.add_argument(
+        "--workers-per-device",
+        default=1,
+        type=int,
+        help="Number of worker processes per device",
+    )
+
     parser_llm.add_argument(
         "--quant-snapshot-dir",
         default=None,
@@ -109,6 +131,14 @@ def get_parser_args():
         help="Apply weighted F Norm for MiLP objective, None or `kurt-scaled`",
     )
 
+    parser_llm.add_argument(
+        "--allocator",
+        default="milp",
+        type=str,
+        choices=ALLOCATORS,
+        help="MXQ bit allocator: one MILP, greedy heuristic or hierarchical MILPs",
+    )
+
     parser_llm.add_argument(
         "--boost-layer",
         nargs="+",
@@ -153,6 +183,21 @@ def get_parser_args():
         help="The top m most sensitive layers to assign extra memory. 0 means all layers.",
     )
 
+    parser_llm.add_argument(
+        "--ppl-batch-size",
+        default=4,
+        type=int,
+        help="Number of sliding windows per forward pass in PPL evaluation",
+    )
+
+    parser_llm.add_argument(
+        "--ppl-tolerance",
+        default=None,
+        type=float,
+        help="Stop PPL evaluation once the 95%% CI is within this relative "
+        "tolerance, e.g. 0.01. Omit for the full-corpus pass",
+    )
+
     parser_llm.add_argument(
         "--ablation",
         dest="ablation",
@@ -299,6 +344,7 @@ def get_parser_args():
             "objective",
             "quant_config",
             "quant_config_sim",
+            "frontier",
         ],
         help="Type of data to dump.",
     )
@@ -341,6 +387,23 @@ def get_parser_args():
         type=str,
         help="Apply weighted F Norm for MiLP objective, None or `kurt-scaled`",
     )
+    parser_dump.add_argument(
+        "--allocator",
+        default="milp",
+        type=str,
+        choices=ALLOCATORS,
+        help="Bit allocator of quant_config_sim: milp, greedy or hier",
+    )
+    parser_dump.add_argument(
+        "--frontier",
+        action="store_true",
+        help="Dump frontier upper bounds as fnorm_ub instead of solving MILPs",
+    )
+    parser_dump.add_argument(
+        "--report-gap",
+        action="store_true",
+        help="Report the objective gap of the allocator against the MILP",
+    )
     parser_dump.add_argument(
         "--factor",
         default=None,
@@ -362,6 +425,28 @@ def get_parser_args():
         help="calibration dataset(s) to use",
     )
 
+    parser_combine = subparsers.add_parser(
+        "combine", help="Export experiment results as csv files"
+    )
+    parser_combine.set_defaults(which="combine")
+    parser_combine.add_argument(
+        "--result-dir",
+        required=True,
+        type=str,
+        help="directory to where evaluation results are stored",
+    )
+    parser_combine.add_argument(
+        "--experiment-name",
+        required=True,
+        type=str,
+        help="name of the experiment",
+    )
+    parser_combine.add_argument(
+        "--partials",
+        action="store_true",
+        help="Also export the per-cell partial-*.csv files of older runs",
+    )
+
     args = parser.parse_args()
     return parser, args
 
@@ -455,6 +540,8 @@ def main():
             main_vit(base)
         elif base.which == "dump":
             main_dump(base)
+        elif base.which == "combine":
+            combine_metrics(base.experiment_name, base.result_dir, base.partials)
     except Exception as e:
         print(e)
         return 1
@@ -471,9 +558,10 @@ def main_llm(args):
     tasks = {algo: {"type": args.task, "configs": configs[algo]} for algo in args.algo}
     experiment_name = args.experiment_name
     if experiment_name is None or len(experiment_name) < 3:
+        task_str = "-".join(args.task)
         algo_str = "-".join(args.algo)
         cfg_str = "-".join(args.config)
-        experiment_name = f"{args.task}-{algo_str}-{cfg_str}"
+        experiment_name = f"{task_str}-{algo_str}-{cfg_str}"
 
     kwargs = {
         "weight_algo": args.weight_algo,
@@ -484,7 +572,13 @@ def main_llm(args):
         "top_m_layer": args.top_m_layer,
         "ablation": args.ablation,
         "factor": args.factor,
+        "ppl_batch_size": args.ppl_batch_size,
+        "ppl_tolerance": args.ppl_tolerance,
+        "allocator": args.allocator,
     }
+    if "mxq" in args.algo:
+        # fail before any model is loaded
+        check_allocator_options(args.allocator, **kwargs)
     do_expermient(
         experiment_name,
         models,
@@ -492,6 +586,8 @@ def main_llm(args):
         quant_dir=args.quant_snapshot_dir,
         result_dir=args.result_dir,
         track_cuda_memory=args.track_cuda_memory,
+        devices=args.devices,
+        workers_per_device=args.workers_per_device,
         **kwargs,
     )
 
@@ -527,11 +623,15 @@ def main_vit(args):
 
 def main_dump(args):
     if args.type == "objective":
-        budgets = args.budget
+        budgets = [float(cfg) for cfg in args.budget]
         csv_fp = args.output_file
         indicies = [int(m) for m in args.model]
         models = [ALL_MODELS[i] for i in indicies]
-        dump_mxq_objectives(models, budgets, csv_fp=csv_fp)
+        dump_mxq_objectives(models, budgets, csv_fp=csv_fp, frontier=args.frontier)
+    elif args.type == "frontier":
+        indicies = [int(m) for m in args.model]
+        models = [ALL_MODELS[i] for i in indicies]
+        dump_mxq_frontier(models, csv_fp=args.output_file)
     elif args.type == "quant_config":
         quant_dir = args.quant_snapshot_dir
         attempts = args.attempt
@@ -567,6 +667,8 @@ def main_dump(args):
             csv_fp=csv_fp,
             weight_algo=args.weight_algo,
             factor=args.factor,
+            allocator=args.allocator,
+            report_gap=args.report_gap,
         )
 
 
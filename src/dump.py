@@ -7,6 +7,7 @@ from timeit import default_timer as timer
 
 from lm_quant_toolkit.prep.fnorm import calc_fnorm_for_model
 from lm_quant_toolkit.prep.sensitivity import measure_sensitivity
+from lm_quant_toolkit.prep.stats import METRIC_PRODUCERS, calc_stats_for_model
 from lm_quant_toolkit.prep.wdist import calculate_kurtosis_llm
 from lm_quant_toolkit.utils.hub import (
     LLAMA_MODELS,
@@ -32,13 +33,14 @@ def get_parser_args():
     parser_sensi.add_argument(
         "--quant-method",
         type=str,
+        nargs="+",
         choices=[
             "hqq",
             "rtn",
             "bnb",
         ],
-        default="hqq",
-        help="Output file location",
+        default=["hqq"],
+        help="Quantization method(s) to measure",
     )
     parser_sensi.add_argument(
         "--output-file",
@@ -60,6 +62,21 @@ def get_parser_args():
         nargs="+",
         help="calibration dataset(s) to use",
     )
+    parser_sensi.add_argument(
+        "--activation-cache-dir",
+        default=None,
+        type=str,
+        help="Directory to cache calibration activations (enables the cache)",
+    )
+    parser_sensi.add_argument(
+        "--activation-cache-gb",
+        default=None,
+        type=float,
+        help=(
+            "Size limit of the activation cache in GB (enables the cache), "
+            "defaults to two entries of the model"
+        ),
+    )
 
     parser_fnorm = subparsers.add_parser("fnorm", help="Evaluate and dump FNorm data")
     parser_fnorm.set_defaults(which="fnorm")
@@ -75,6 +92,12 @@ def get_parser_args():
         default="data",
         help="Output directory",
     )
+    parser_fnorm.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to compute (layer, module) units in parallel",
+    )
 
     parser_kurt = subparsers.add_parser(
         "kurtosis", help="Evaluate and dump model kurtosis data"
@@ -93,6 +116,31 @@ def get_parser_args():
         help="Output directory",
     )
 
+    parser_stats = subparsers.add_parser(
+        "stats", help="Evaluate and dump all weight statistics in one pass"
+    )
+    parser_stats.set_defaults(which="stats")
+    parser_stats.add_argument(
+        "--model",
+        type=str,
+        nargs="+",
+        help="Model to evaluate",
+    )
+    parser_stats.add_argument(
+        "--metric",
+        type=str,
+        nargs="+",
+        choices=list(METRIC_PRODUCERS),
+        default=None,
+        help="Metrics to compute, all by default",
+    )
+    parser_stats.add_argument(
+        "--output-dir",
+        type=str,
+        default="data",
+        help="Output directory",
+    )
+
     args = parser.parse_args()
     return parser, args
 
@@ -110,6 +158,8 @@ def main():
             main_fnorm(base)
         elif base.which == "kurtosis":
             main_kurt(base)
+        elif base.which == "stats":
+            main_stats(base)
     except Exception as e:
         print(e)
         return 1
@@ -121,8 +171,16 @@ def main_sensi(args):
     models = args.model
     cfgs = args.config
     calib_ds = args.calib_dataset
-    quant_method = args.quant_method
-    measure_sensitivity(models, quant_method, cfgs, calib_ds, csv_fp)
+    quant_methods = args.quant_method
+    measure_sensitivity(
+        models,
+        quant_methods,
+        cfgs,
+        calib_ds,
+        csv_fp,
+        activation_cache_dir=args.activation_cache_dir,
+        activation_cache_gb=args.activation_cache_gb,
+    )
 
 
 def main_fnorm(args):
@@ -142,6 +200,7 @@ def main_fnorm(args):
             model_base_dir,
             model["layers"],
             output_dir,
+            workers=args.workers,
         )
         t2 = timer()
         print(f"Finished {model_id} Frobenius norm metrics calc in {t2 - t1} seconds")
@@ -169,5 +228,29 @@ def main_kurt(args):
         print(f"Finished {model_id} Kurtosis metrics calc in {t2 - t1} seconds")
 
 
+def main_stats(args):
+    if not args.model or len(args.model) < 1:
+        raise ValueError("At least one model is required")
+    output_dir = args.output_dir
+    for model_id in args.model:
+        model = LLAMA_MODELS[model_id]
+        if not model:
+            raise ValueError(f"Unsupported model: {model_id}")
+
+        t1 = timer()
+        base_dir = model.get("base_dir", None)
+        model_base_dir = get_hf_model_storge_base_dir(model_id, base_dir)
+        calc_stats_for_model(
+            model_id,
+            model_base_dir,
+            model["layers"],
+            output_dir,
+            metrics=args.metric,
+            llama2=model.get("llama2", True),
+        )
+        t2 = timer()
+        print(f"Finished {model_id} weight statistics calc in {t2 - t1} seconds")
+
+
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
@@ -1,41 +1,26 @@
 import gc
 import os
-import random
 import time
 
 import torch
 import transformers
 from auto_gptq import AutoGPTQForCausalLM
-from datasets import load_dataset
-from tqdm import tqdm
+
+from lm_quant_toolkit.utils.calib import get_calib_blocks, iter_calib_examples
 
 
 # Adapted from: https://towardsdatascience.com/4-bit-quantization-with-gptq-36b0f4f02c34
 def prepare_model(model, tokenizer, n_samples=1024, max_tokens=512, use_triton=False):
-    # Load data and tokenize examples
-    data = load_dataset(
-        "allenai/c4",
-        data_files="en/c4-train.00001-of-01024.json.gz",
-        split=f"train[:{n_samples}]",
-    )
-    # ~536K tokens
-    tokenized_data = torch.cat(
-        [
-            tokenizer(data[i]["text"], return_tensors="pt").input_ids
-            for i in tqdm(range(len(data)))
-        ],
-        axis=-1,
+    # Load tokenized examples, ~536K tokens are sampled from the c4 shard
+    blocks = get_calib_blocks(
+        tokenizer,
+        data="c4-train",
+        n_samples=n_samples,
+        block_size=max_tokens,
+        seed=1,
+        sampling="random",
     )
-
-    # Format tokenized examples
-    random.seed(1)
-    examples_ids = []
-    for _ in range(n_samples):
-        i = random.randint(0, tokenized_data.shape[1] - max_tokens - 1)
-        j = i + max_tokens
-        input_ids = tokenized_data[:, i:j]
-        attention_mask = torch.ones_like(input_ids)
-        examples_ids.append({"input_ids": input_ids, "attention_mask": attention_mask})
+    examples_ids = list(iter_calib_examples(blocks))
 
     print("Using " + str(len(examples_ids)) + " samples for calibration.")
     model.quantize(examples_ids, batch_size=1, use_triton=use_triton)
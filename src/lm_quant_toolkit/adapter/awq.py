@@ -1,3 +1,4 @@
+import contextlib
 import os
 import time
 
@@ -7,11 +8,35 @@ from accelerate import (
     init_empty_weights,
     load_checkpoint_in_model,
 )
+from awq.quantize import pre_quant
 from awq.quantize.pre_quant import apply_awq, run_awq
 from awq.quantize.quantizer import real_quantize_model_weight
 from awq.utils.utils import simple_dispatch_model
 from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
 
+from lm_quant_toolkit.utils.calib import get_calib_blocks
+
+
+def _get_calib_dataset(
+    data="pileval", tokenizer=None, n_samples=512, block_size=512, **kwargs
+):
+    # same shuffled pileval lines as llm-awq, read from the shared store
+    blocks = get_calib_blocks(
+        tokenizer, data=data, n_samples=n_samples, block_size=block_size
+    )
+    return [block.long().unsqueeze(0) for block in blocks]
+
+
+@contextlib.contextmanager
+def shared_calib_blocks():
+    """Make run_awq read its calibration blocks from get_calib_blocks."""
+    original = pre_quant.get_calib_dataset
+    pre_quant.get_calib_dataset = _get_calib_dataset
+    try:
+        yield
+    finally:
+        pre_quant.get_calib_dataset = original
+
 
 def create_awq_model(model_id, quant_config, config_id, load_quantized, save_dir):
     quantized = False
@@ -64,14 +89,15 @@ def create_awq_model(model_id, quant_config, config_id, load_quantized, save_dir
 def quantize_awq_model(model, tokenizer, quant_config, model_id, config_id, save_dir):
     t1 = time.time()
     nbits = quant_config.pop("w_bit")
-    awq_results = run_awq(
-        model,
-        tokenizer,
-        w_bit=nbits,
-        q_config=quant_config,
-        n_samples=128,
-        seqlen=512,
-    )
+    with shared_calib_blocks():
+        awq_results = run_awq(
+            model,
+            tokenizer,
+            w_bit=nbits,
+            q_config=quant_config,
+            n_samples=128,
+            seqlen=512,
+        )
     intermediate_fp = f"{save_dir}/{model_id}-{config_id}-awq/intermediate.pth"
     dirpath = os.path.dirname(intermediate_fp)
     os.makedirs(dirpath, exist_ok=True)
@@ -1,12 +1,35 @@
 import json
 import os
 
+import torch
+
 
 def get_model_storage_size(
     base_dir,
     index_file="model.safetensors.index.json",
     model_file="model.safetensors",
+    physical=False,
 ):
+    """Size in bytes of the checkpoint or HQQ/MXQ snapshot in `base_dir`.
+
+    Snapshots count the blob store tensors they reference, i.e. the size of
+    a self-contained qmodel.pt. With `physical` a (logical, physical) tuple
+    is returned, physical being the bytes stored in `base_dir` itself.
+    """
+    snapshot_file = os.path.join(base_dir, "qmodel.pt")
+    if os.path.exists(snapshot_file):
+        size = os.path.getsize(snapshot_file)
+        physical_size = size
+        refs_file = os.path.join(base_dir, "blobs.json")
+        if os.path.exists(refs_file):
+            with open(refs_file, "r") as f:
+                entry = json.load(f)
+            blob_dir = os.path.join(base_dir, entry["blob_dir"])
+            for tensors in entry["refs"].values():
+                for digest in tensors.values():
+                    size += os.path.getsize(os.path.join(blob_dir, f"{digest}.pt"))
+        return (size, physical_size) if physical else size
+
     size = 0
     index_file = os.path.join(base_dir, index_file)
     if os.path.exists(index_file):
@@ -17,4 +40,9 @@ def get_model_storage_size(
                 size += os.path.getsize(os.path.join(base_dir, shard))
     else:
         size = os.path.getsize(os.path.join(base_dir, model_file))
-    return size
+    return (size, size) if physical else size
+
+
+def get_quant_device():
+    """Device to quantize on, CPU when no GPU is visible to the process."""
+    return "cuda" if torch.cuda.is_available() else "cpu"
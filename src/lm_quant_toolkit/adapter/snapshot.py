@@ -0,0 +1,171 @@
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import torch
+from hqq.models.base import BaseHQQModel
+
+from lm_quant_toolkit.utils.cache import touch
+
+# blob store directory under the quantized snapshot root
+SNAPSHOT_BLOB_DIR = ".blobs"
+# sidecar of a snapshot listing the tensors kept in the blob store
+BLOB_REFS_FILE = "blobs.json"
+# smaller tensors (norms, biases) stay inline in qmodel.pt
+MIN_BLOB_BYTES = 1024**2
+
+_blob_dir = None
+# hqq's own snapshot weights io, wrapped by `snapshot_store`
+_hqq_weights_io = {
+    "save": vars(BaseHQQModel)["save_weights"],
+    "load": vars(BaseHQQModel)["load_weights"],
+}
+
+
+@contextlib.contextmanager
+def snapshot_store(blob_dir):
+    """Route HQQ snapshot weights of non-quantized modules through `blob_dir`.
+
+    Large tensors of non-quantized modules (embed_tokens, lm_head, ...) are
+    the same in every HQQ and MXQ snapshot of a model. Snapshots saved
+    inside the block write them once to `blob_dir` under their content hash
+    and only reference them, snapshots loaded inside the block get them
+    back. hqq's weights io is restored when the block exits.
+    """
+    global _blob_dir
+    saved = (
+        _blob_dir,
+        vars(BaseHQQModel)["save_weights"],
+        vars(BaseHQQModel)["load_weights"],
+    )
+    _blob_dir = os.path.abspath(blob_dir)
+    BaseHQQModel.save_weights = classmethod(_save_weights)
+    BaseHQQModel.load_weights = classmethod(_load_weights)
+    try:
+        yield
+    finally:
+        _blob_dir, BaseHQQModel.save_weights, BaseHQQModel.load_weights = saved
+
+
+def weight_fingerprint(weight):
+    """Content hash of a weight tensor, independent of its device."""
+    data = weight.detach().cpu().contiguous().view(torch.uint8).numpy()
+    h = hashlib.sha256(data.tobytes())
+    h.update(f"{weight.dtype}{tuple(weight.shape)}".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _save_blob(tensor):
+    digest = weight_fingerprint(tensor)
+    fp = os.path.join(_blob_dir, f"{digest}.pt")
+    if os.path.exists(fp):
+        # fresh mtime keeps `gc_blobs` off blobs of snapshots being saved
+        touch(fp)
+        return digest
+    fd, tmp = tempfile.mkstemp(dir=_blob_dir, prefix=f".{digest}.")
+    os.close(fd)
+    try:
+        # clone so views don't drag their whole storage along
+        torch.save(tensor.detach().cpu().clone(), tmp)
+        # another snapshot may have stored the same blob meanwhile
+        if not os.path.exists(fp):
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, fp)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return digest
+
+
+def _save_weights(cls, weights, save_dir):
+    refs_fp = os.path.join(save_dir, BLOB_REFS_FILE)
+    os.makedirs(_blob_dir, exist_ok=True)
+    inline = {}
+    refs = {}
+    for name, state_dict in weights.items():
+        if "W_q" in state_dict:
+            inline[name] = state_dict
+            continue
+        kept = {}
+        for key, value in state_dict.items():
+            if (
+                torch.is_tensor(value)
+                and value.numel() * value.element_size() >= MIN_BLOB_BYTES
+            ):
+                refs.setdefault(name, {})[key] = _save_blob(value)
+            else:
+                kept[key] = value
+        if kept:
+            inline[name] = kept
+    _hqq_weights_io["save"].__func__(cls, inline, save_dir)
+    with open(refs_fp, "w") as fh:
+        json.dump({"blob_dir": os.path.relpath(_blob_dir, save_dir), "refs": refs}, fh)
+
+
+def _load_weights(cls, save_dir, map_location=None):
+    weights = _hqq_weights_io["load"].__func__(cls, save_dir, map_location=map_location)
+    return hydrate_weights(weights, save_dir, map_location)
+
+
+def _read_refs(save_dir):
+    refs_fp = os.path.join(save_dir, BLOB_REFS_FILE)
+    if not os.path.exists(refs_fp):
+        return None, {}
+    with open(refs_fp, "r") as fh:
+        entry = json.load(fh)
+    return os.path.join(save_dir, entry["blob_dir"]), entry["refs"]
+
+
+def hydrate_weights(weights, save_dir, map_location=None):
+    """Put the blob store tensors referenced by snapshot `save_dir` back."""
+    blob_dir, refs = _read_refs(save_dir)
+    for name, tensors in refs.items():
+        state_dict = weights.setdefault(name, {})
+        for key, digest in tensors.items():
+            state_dict[key] = torch.load(
+                os.path.join(blob_dir, f"{digest}.pt"), map_location=map_location
+            )
+    return weights
+
+
+def load_snapshot(save_dir, map_location="cpu"):
+    """All weights of an HQQ/MXQ snapshot, including blob store tensors."""
+    weights = torch.load(os.path.join(save_dir, "qmodel.pt"), map_location=map_location)
+    return hydrate_weights(weights, save_dir, map_location)
+
+
+def gc_blobs(quant_dir, min_age=3600):
+    """Remove blobs of `quant_dir` no snapshot under it references anymore.
+
+    Blobs younger than `min_age` seconds are kept, since a snapshot being
+    saved writes its blobs before its blobs.json. Returns the number of
+    bytes freed.
+    """
+    blob_dir = os.path.realpath(os.path.join(quant_dir, SNAPSHOT_BLOB_DIR))
+    if not os.path.isdir(blob_dir):
+        return 0
+    referenced = set()
+    for root, _, files in os.walk(quant_dir):
+        if BLOB_REFS_FILE not in files:
+            continue
+        refs_dir, refs = _read_refs(root)
+        if os.path.realpath(refs_dir) != blob_dir:
+            continue
+        for tensors in refs.values():
+            referenced.update(tensors.values())
+
+    freed = 0
+    for name in os.listdir(blob_dir):
+        path = os.path.join(blob_dir, name)
+        digest, ext = os.path.splitext(name)
+        # skip temporary files of blobs being written
+        if ext != ".pt" or name.startswith(".") or digest in referenced:
+            continue
+        if time.time() - os.path.getmtime(path) < min_age:
+            continue
+        freed += os.path.getsize(path)
+        os.remove(path)
+    return freed
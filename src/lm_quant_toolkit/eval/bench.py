@@ -1,11 +1,11 @@
 import copy
+import functools
 import logging
 import os
 
 # from adapter.awq import create_awq_model
 # from adapter.awq import quantize_awq_model
 from datetime import datetime
-from pathlib import Path
 
 import pandas as pd
 import torch
@@ -22,6 +22,7 @@ from lm_quant_toolkit.adapter.gm import (
     quantize_gptq_model,
 )
 from lm_quant_toolkit.adapter.bnb import create_bnb_model, quantize_bnb_model
+from lm_quant_toolkit.adapter.common import get_model_storage_size
 from lm_quant_toolkit.adapter.fp16 import create_fp16_model
 from lm_quant_toolkit.adapter.hqq import create_hqq_model, quantize_hqq_model
 from lm_quant_toolkit.adapter.mxq import create_mxq_model, quantize_mxq_model
@@ -33,11 +34,17 @@ from lm_quant_toolkit.eval.common import (
     combine_metrics,
     get_memory_metrics,
     get_mxq_quant_meta_data_file,
-    persist_progress,
+    load_partial_metric,
     save_partial_metric,
 )
 from lm_quant_toolkit.eval.leaderboard import eval_llm_leaderboard
 from lm_quant_toolkit.eval.perplexity import eval_ppls
+from lm_quant_toolkit.eval.progress import FAILED, PENDING, open_progress_store
+from lm_quant_toolkit.eval.scheduler import ExperimentScheduler, estimate_footprint
+from lm_quant_toolkit.misc.allocator import (
+    check_allocator_options,
+    get_allocation_metrics_file,
+)
 
 ALL_MODELS = [
     "meta-llama/Llama-2-7b-hf",
@@ -126,20 +133,28 @@ GPTQ_CONFIGS = [
 ]
 
 
+# order in which the tasks of one (model, algo, cfg) cell are executed
+TASK_TYPES = ["quant", "eval_model_storage", "eval_ppl", "eval_leaderboard"]
+
+
 def gen_experiment_items(models, tasks):
     dikts = []
     for algo, spec in tasks.items():
         configs = spec["configs"]
+        task_types = spec["type"]
+        if isinstance(task_types, str):
+            task_types = [task_types]
         for config in configs:
             for model_id in models:
-                dikts.append(
-                    {
-                        "model": model_id,
-                        "cfg": config[0],
-                        "task_type": spec["type"],
-                        "algo": algo,
-                    }
-                )
+                for task_type in task_types:
+                    dikts.append(
+                        {
+                            "model": model_id,
+                            "cfg": config[0],
+                            "task_type": task_type,
+                            "algo": algo,
+                        }
+                    )
     return pd.DataFrame(dikts)
 
 
@@ -175,46 +190,222 @@ def do_expermient(
     result_dir="results",
     log_dir="logs",
     track_cuda_memory=False,
+    devices=None,
+    workers_per_device=1,
     **kwargs,
 ):
+    """Run the pending sub-tasks of an experiment and combine their metrics.
+
+    By default the cells run serially in this process. With `devices` (e.g.
+    ["cuda:0", "cuda:1", "cpu"]) they are scheduled on worker processes, see
+    `ExperimentScheduler`.
+    """
     df_all = gen_experiment_items(models, tasks)
-    progress_path = os.path.join(result_dir, experiment_name, "progress.csv")
-    if Path(progress_path).exists():
-        df_saved = pd.read_csv(progress_path)
-        df_all = df_all.merge(
-            df_saved, how="left", on=["model", "cfg", "task_type", "algo"]
-        )
-        # filter already processed repos, equivalent to SQL is null
-        df_todo = df_all.query("status != status or status != 1")
-    else:
-        df_all["status"] = 0
-        df_all["completion_time"] = ""
-        df_todo = df_all
+    store = open_progress_store(
+        experiment_name, result_dir, df_all.to_dict(orient="records")
+    )
+    df_todo = store.tasks(experiment_name, states=[PENDING, FAILED])
     print("*" * 72)
     print("Sub-task list:")
-    print(df_all)
+    print(store.tasks(experiment_name))
     cnt_todo, cnt_tot = len(df_todo), len(df_all)
     print(f"Todo:{cnt_todo}, Done: {cnt_tot - cnt_todo}, Total: {cnt_tot}")
     if cnt_todo == 0:
         print("Tasks completed!")
     print("*" * 72)
     if cnt_todo == 0:
+        store.close()
         return
 
     df_todo = df_todo.sort_values(by=["model", "cfg"], ascending=False)
-    for idx, row in df_todo.iterrows():
-        model_id = row["model"]
-        algo = row["algo"]
-        task_type = row["task_type"]
-        cfg = row["cfg"]
+
+    # every (model, algo, cfg) cell is loaded or quantized once and all of its
+    # pending tasks are evaluated on the same in-memory model
+    cells = []
+    for (model_id, algo, cfg), df_cell in df_todo.groupby(
+        ["model", "algo", "cfg"], sort=False
+    ):
+        task_types = sorted(df_cell["task_type"], key=TASK_TYPES.index)
         spec = tasks[algo]
         _setup_fn(algo, spec)
-        config = [c for c in spec["configs"] if c[0] == cfg][0]
-        quant_fn = spec["quantize_fn"]
-        metric = _init_metrics(model_id, algo, config)
+        cells.append((model_id, algo, cfg, task_types, spec))
+
+    def claim(key, task_types):
+        # claimed when dispatched, so other processes and hosts can pick up
+        # the cells this one hasn't reached yet
+        return [
+            task_type
+            for task_type in task_types
+            if store.claim(experiment_name, (*key, task_type))
+        ]
+
+    def mark(state, key, task_types, **fields):
+        for task_type in task_types:
+            getattr(store, state)(experiment_name, (*key, task_type), **fields)
+
+    def mark_done(key, task_type, completion_time):
+        mark("done", key, [task_type], completion_time=completion_time)
+
+    if devices is None:
+        for model_id, algo, cfg, task_types, spec in cells:
+            key = (model_id, algo, cfg)
+            # skip sub-tasks claimed meanwhile by another process or host
+            task_types = claim(key, task_types)
+            if not task_types:
+                continue
+            mark("start", key, task_types)
+            try:
+                completed = _run_cell(
+                    experiment_name,
+                    model_id,
+                    algo,
+                    cfg,
+                    task_types,
+                    spec,
+                    quant_dir,
+                    result_dir,
+                    track_cuda_memory,
+                    kwargs,
+                    on_task_done=functools.partial(mark_done, key),
+                )
+            except Exception as e:
+                mark("fail", key, task_types, error=e)
+                store.close()
+                raise
+            unfinished = set(task_types) - {task_type for task_type, _ in completed}
+            mark("fail", key, unfinished, error="not completed")
+    else:
+        # cells complete out of order, progress is updated by sub-task key
+        jobs = [
+            (
+                (model_id, algo, cfg, tuple(task_types)),
+                estimate_footprint(model_id),
+                _run_cell,
+                (
+                    experiment_name,
+                    model_id,
+                    algo,
+                    cfg,
+                    task_types,
+                    spec,
+                    quant_dir,
+                    result_dir,
+                    track_cuda_memory,
+                    kwargs,
+                ),
+            )
+            for model_id, algo, cfg, task_types, spec in cells
+        ]
+
+        def on_start(job_key, args):
+            key = job_key[:3]
+            # skip sub-tasks claimed meanwhile by another process or host
+            task_types = claim(key, job_key[3])
+            if not task_types:
+                return None
+            mark("start", key, task_types)
+            # run the claimed sub-tasks only, args[4] is the task list
+            args = (*args[:4], task_types, *args[5:])
+            return (*key, tuple(task_types)), args
+
+        def on_done(job_key, completed):
+            for task_type, completion_time in completed:
+                mark_done(job_key[:3], task_type, completion_time)
+            unfinished = set(job_key[3]) - {task_type for task_type, _ in completed}
+            mark("fail", job_key[:3], unfinished, error="not completed")
+
+        def on_error(job_key, exc):
+            print(f"Cell {job_key[:3]} failed: {exc}")
+            mark("fail", job_key[:3], job_key[3], error=exc)
+
+        with ExperimentScheduler(devices, workers_per_device) as scheduler:
+            scheduler.run(jobs, on_done, on_error=on_error, on_start=on_start)
+    store.close()
+    # combine metrics
+    combine_metrics(experiment_name, result_dir)
+
+
+def _run_cell(
+    experiment_name,
+    model_id,
+    algo,
+    cfg,
+    task_types,
+    spec,
+    quant_dir,
+    result_dir,
+    track_cuda_memory,
+    kwargs,
+    on_task_done=None,
+):
+    """Load or quantize one model config and run `task_types` on it.
+
+    Returns the list of (task_type, completion_time) of the finished tasks.
+    """
+    config = [c for c in spec["configs"] if c[0] == cfg][0]
+    quant_fn = spec["quantize_fn"]
+    metric = _init_metrics(model_id, algo, config)
+    # keep the metrics of tasks completed in earlier runs
+    metric.update(load_partial_metric(experiment_name, algo, model_id, cfg, result_dir))
+
+    if track_cuda_memory:
+        torch.cuda.memory._record_memory_history()
+    _reset_peak_memory_stats()
+    model = tokenizer = None
+    model_file_size = 0
+    # lm_eval loads the saved model itself, don't quantize for it alone
+    if any(task_type != "eval_leaderboard" for task_type in task_types):
+        create_fn = spec["create_fn"]
+        model, tokenizer, quantized, model_file_size = create_fn(
+            model_id, config[1], cfg, quant_fn is not None, quant_dir
+        )
+
+        if not quantized and quant_fn:
+            print("*" * 72)
+            print(f"Quantizing {algo} on {model_id} w/ config: {cfg}...")
+            print("*" * 72)
+            # avoid interventions between models
+            quant_config = copy.deepcopy(config[1])
+            if algo == "mxq":
+                ok, metric_fp = get_mxq_quant_meta_data_file(model_id)
+                if not ok:
+                    print(f"Quantization meta data file: {metric_fp} doesn't exists!")
+                    return []
+                allocator = kwargs.get("allocator", None) or "milp"
+                check_allocator_options(allocator, **kwargs)
+                if allocator != "milp":
+                    # pin the MILP of the quantizer to the allocator's solution
+                    metric_fp = get_allocation_metrics_file(
+                        metric_fp,
+                        float(cfg.replace("_", ".")),
+                        allocator,
+                        weight_algo=kwargs.get("weight_algo", None),
+                        factor=kwargs.get("factor", None),
+                    )
+                quant_config["quant_metrics_file"] = metric_fp
+                quant_config["weight_algo"] = kwargs.get("weight_algo", None)
+                quant_config["boost_layers"] = kwargs.get("boost_layers", None)
+                quant_config["decline_layers"] = kwargs.get("decline_layers", None)
+                quant_config["boost_stop"] = kwargs.get("boost_stop", None)
+                quant_config["decline_stop"] = kwargs.get("decline_stop", None)
+                quant_config["ablation"] = kwargs.get("ablation", None)
+                quant_config["top_m_layer"] = kwargs.get("top_m_layer", None)
+                quant_config["factor"] = kwargs.get("factor", None)
+            model, duration, model_file_size = quant_fn(
+                model,
+                tokenizer,
+                quant_config,
+                model_id,
+                cfg,
+                quant_dir,
+            )
+            metric["quant_duration"] = duration
+
+    completed = []
+    for task_type in task_types:
         print("*" * 72)
         if task_type == "quant":
-            print(f"Quantizing {algo} on {model_id} w/ config: {cfg}...")
+            print(f"Quantized {algo} on {model_id} w/ config: {cfg}")
         elif task_type == "eval_ppl":
             print(f"Evaluating {algo} PPL on {model_id} w/ config: {cfg}...")
         elif task_type == "eval_leaderboard":
@@ -227,59 +418,29 @@ def do_expermient(
             )
         print("*" * 72)
 
-        if track_cuda_memory:
-            torch.cuda.memory._record_memory_history()
-        _reset_peak_memory_stats()
-        if task_type != "eval_leaderboard":
-            create_fn = spec["create_fn"]
-            model, tokenizer, quantized, model_file_size = create_fn(
-                model_id, config[1], cfg, quant_fn is not None, quant_dir
-            )
-
-            if not quantized and quant_fn:
-                # avoid interventions between models
-                quant_config = copy.deepcopy(config[1])
-                if algo == "mxq":
-                    ok, metric_fp = get_mxq_quant_meta_data_file(model_id)
-                    if not ok:
-                        print(
-                            f"Quantization meta data file: {metric_fp} doesn't exists!"
-                        )
-                        return
-                    quant_config["quant_metrics_file"] = metric_fp
-                    quant_config["weight_algo"] = kwargs.get("weight_algo", None)
-                    quant_config["boost_layers"] = kwargs.get("boost_layers", None)
-                    quant_config["decline_layers"] = kwargs.get("decline_layers", None)
-                    quant_config["boost_stop"] = kwargs.get("boost_stop", None)
-                    quant_config["decline_stop"] = kwargs.get("decline_stop", None)
-                    quant_config["ablation"] = kwargs.get("ablation", None)
-                    quant_config["top_m_layer"] = kwargs.get("top_m_layer", None)
-                    quant_config["factor"] = kwargs.get("factor", None)
-                model, duration, model_file_size = quant_fn(
-                    model,
-                    tokenizer,
-                    quant_config,
-                    model_id,
-                    cfg,
-                    quant_dir,
+        if task_type == "eval_model_storage":
+            allot, reserved = get_memory_metrics()
+            metric["load_mem_allot"] = allot
+            metric["load_mem_reserved"] = reserved
+            metric["model_storage_size"] = model_file_size
+            quant_path = f"{quant_dir}/{model_id}-{cfg}-{algo}"
+            if algo in ["hqq", "mxq"] and os.path.exists(quant_path):
+                # shared tensors live in the snapshot blob store
+                _, metric["model_physical_size"] = get_model_storage_size(
+                    quant_path, physical=True
                 )
-                metric["quant_duration"] = duration
-            if task_type == "eval_model_storage":
-                allot, reserved = get_memory_metrics()
-                metric["load_mem_allot"] = allot
-                metric["load_mem_reserved"] = reserved
-                metric["model_storage_size"] = model_file_size
-
-            elif task_type == "eval_ppl":
-                # Evaluate the quantized model
-                metric = eval_ppls(model, tokenizer, metric)
-                metric["ppl_mem_allot"], metric["ppl_mem_reserved"] = (
-                    get_memory_metrics()
-                )
-            if track_cuda_memory:
-                _dump_cuda_mem_snapshot(experiment_name, model_id, algo, result_dir)
-            cleanup(model)
-        else:
+        elif task_type == "eval_ppl":
+            # Evaluate the quantized model
+            metric = eval_ppls(
+                model,
+                tokenizer,
+                metric,
+                batch_size=kwargs.get("ppl_batch_size", None) or 4,
+                tolerance=kwargs.get("ppl_tolerance", None),
+            )
+            metric["ppl_mem_allot"], metric["ppl_mem_reserved"] = get_memory_metrics()
+        elif task_type == "eval_leaderboard":
+            # hand the live model to lm_eval instead of reloading it
             metric = eval_llm_leaderboard(
                 experiment_name,
                 model_id,
@@ -289,23 +450,21 @@ def do_expermient(
                 metric,
                 quant_dir,
                 result_dir,
+                model=model,
+                tokenizer=tokenizer,
             )
             metric["leaderboard_mem_allot"], metric["leaderboard_mem_reserved"] = (
                 get_memory_metrics()
             )
-            if track_cuda_memory:
-                _dump_cuda_mem_snapshot(experiment_name, model_id, algo, result_dir)
-        save_partial_metric(experiment_name, algo, model_id, cfg, metric, result_dir)
-        df_all.loc[
-            (df_all["model"] == model_id)
-            & (df_all["cfg"] == cfg)
-            & (df_all["algo"] == algo)
-            & (df_all["task_type"] == task_type),
-            ["status", "completion_time"],
-        ] = 1, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        persist_progress(df_all, progress_path)
-    # combine metrics
-    combine_metrics(experiment_name, result_dir)
+        save_partial_metric(experiment_name, metric, result_dir)
+        completion_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        completed.append((task_type, completion_time))
+        if on_task_done is not None:
+            on_task_done(task_type, completion_time)
+    if track_cuda_memory:
+        _dump_cuda_mem_snapshot(experiment_name, model_id, algo, result_dir)
+    cleanup(model)
+    return completed
 
 
 def _init_metrics(model_id, algo, config):
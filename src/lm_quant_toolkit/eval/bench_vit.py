@@ -1,7 +1,6 @@
 import copy
 import logging
 import os
-from datetime import datetime
 from pathlib import Path
 
 import pandas as pd
@@ -20,9 +19,9 @@ from lm_quant_toolkit.eval.common import (
     combine_metrics,
     get_memory_metrics,
     get_mxq_quant_meta_data_file,
-    persist_progress,
     save_partial_metric,
 )
+from lm_quant_toolkit.eval.progress import FAILED, PENDING, open_progress_store
 
 ALL_MODELS = [
     "laion/CLIP-ViT-B-32-laion2B-s34B-b79K",
@@ -85,27 +84,20 @@ def do_expermient(
     **kwargs,
 ):
     df_all = gen_experiment_items(models, tasks)
-    progress_path = os.path.join(result_dir, experiment_name, "progress.csv")
-    if Path(progress_path).exists():
-        df_saved = pd.read_csv(progress_path)
-        df_all = df_all.merge(
-            df_saved, how="left", on=["model", "cfg", "task_type", "algo"]
-        )
-        # filter already processed repos, equivalent to SQL is null
-        df_todo = df_all.query("status != status or status != 1")
-    else:
-        df_all["status"] = 0
-        df_all["completion_time"] = ""
-        df_todo = df_all
+    store = open_progress_store(
+        experiment_name, result_dir, df_all.to_dict(orient="records")
+    )
+    df_todo = store.tasks(experiment_name, states=[PENDING, FAILED])
     print("*" * 72)
     print("Sub-task list:")
-    print(df_all)
+    print(store.tasks(experiment_name))
     cnt_todo, cnt_tot = len(df_todo), len(df_all)
     print(f"Todo:{cnt_todo}, Done: {cnt_tot - cnt_todo}, Total: {cnt_tot}")
     if cnt_todo == 0:
         print("Tasks completed!")
     print("*" * 72)
     if cnt_todo == 0:
+        store.close()
         return
 
     df_todo = df_todo.sort_values(by=["model", "cfg"], ascending=False)
@@ -114,6 +106,11 @@ def do_expermient(
         algo = row["algo"]
         task_type = row["task_type"]
         cfg = row["cfg"]
+        key = (model_id, algo, cfg, task_type)
+        # skip sub-tasks claimed meanwhile by another process or host
+        if not store.claim(experiment_name, key):
+            continue
+        store.start(experiment_name, key)
         spec = tasks[algo]
         config = [c for c in spec["configs"] if c[0] == cfg][0]
         metric = _init_metrics(model_id, algo, config)
@@ -140,6 +137,8 @@ def do_expermient(
                 ok, metric_fp = get_mxq_quant_meta_data_file(model_id)
                 if not ok:
                     print(f"Quantization meta data file: {metric_fp} doesn't exists!")
+                    store.fail(experiment_name, key, "missing quant meta data")
+                    store.close()
                     return
                 quant_config["quant_metrics_file"] = metric_fp
                 quant_config["weight_algo"] = kwargs.get("weight_algo", None)
@@ -180,15 +179,9 @@ def do_expermient(
 
         if track_cuda_memory:
             _dump_cuda_mem_snapshot(experiment_name, model_id, algo, result_dir)
-        save_partial_metric(experiment_name, algo, model_id, cfg, metric, result_dir)
-        df_all.loc[
-            (df_all["model"] == model_id)
-            & (df_all["cfg"] == cfg)
-            & (df_all["algo"] == algo)
-            & (df_all["task_type"] == task_type),
-            ["status", "completion_time"],
-        ] = 1, datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        persist_progress(df_all, progress_path)
+        save_partial_metric(experiment_name, metric, result_dir)
+        store.done(experiment_name, key)
+    store.close()
     # combine metrics
     combine_metrics(experiment_name, result_dir)
 
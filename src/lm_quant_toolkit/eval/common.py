@@ -1,5 +1,4 @@
 import gc
-import glob
 import os
 from datetime import datetime
 from pathlib import Path
@@ -7,8 +6,17 @@ from pathlib import Path
 import pandas as pd
 import torch
 from hqq.core.quantize import BaseQuantizeConfig as HQQQuantConfig
-from hqq.utils.optimizer import find_optimal_configs
 
+from lm_quant_toolkit.eval.results import (
+    compact_results,
+    export_partials,
+    import_legacy_partials,
+    read_results,
+    upsert_results,
+)
+from lm_quant_toolkit.misc.feasibility import snap_common_budget
+from lm_quant_toolkit.misc.planner import plan_budgets
+from lm_quant_toolkit.misc.solver import solve_mxq
 from lm_quant_toolkit.utils.hub import LLAMA_MODELS, VIT_OPENCLIP_MODELS
 
 HQQ_CONFIGS = [
@@ -34,20 +42,32 @@ def get_mxq_quant_meta_data_file(model_id):
     return os.path.exists(fp), os.path.abspath(fp)
 
 
-def persist_progress(df, progress_path):
-    """Save the progress of experiment for resumption."""
-    Path(progress_path).parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(progress_path, index=False)
+def save_partial_metric(experiment_name, metric, result_dir):
+    """Upsert the metric of one model config into the experiment results file.
 
+    The row is keyed by the `model`, `algo` and `config` fields of `metric`.
+    """
+    upsert_results(experiment_name, [metric], result_dir)
 
-def save_partial_metric(experiment_name, algo, model_id, config, metric, result_dir):
-    metrics = [metric]
-    df = pd.DataFrame(metrics)
-    result_dir = os.path.join(result_dir, experiment_name)
-    os.makedirs(result_dir, exist_ok=True)
+
+def load_partial_metric(experiment_name, algo, model_id, config, result_dir):
+    """Return the metric saved by `save_partial_metric`, or an empty dict."""
     model_short_id = model_id.split("/")[1]
+    df = read_results(experiment_name, result_dir)
+    if len(df) > 0:
+        df = df[
+            (df["model"] == model_short_id)
+            & (df["algo"] == algo)
+            & (df["config"] == config)
+        ]
+        if len(df) > 0:
+            return df.iloc[0].dropna().to_dict()
+    # partial csv files of older runs
+    result_dir = os.path.join(result_dir, experiment_name)
     file_name = f"{result_dir}/partial-{algo}-{model_short_id}-{config}.csv"
-    df.to_csv(file_name, index=False)
+    if not os.path.exists(file_name):
+        return {}
+    return pd.read_csv(file_name).iloc[0].to_dict()
 
 
 def _dump_cuda_mem_snapshot(experiment_name, model_id, algo, result_dir):
@@ -55,17 +75,20 @@ def _dump_cuda_mem_snapshot(experiment_name, model_id, algo, result_dir):
     torch.cuda.memory._dump_snapshot(mem_fp)
 
 
-def combine_metrics(experiment_name, result_dir):
-    dfs = []
-    iters = glob.iglob(f"{result_dir}/{experiment_name}/partial-*.csv")
-    for it in iters:
-        df = pd.read_csv(it)
-        dfs.append(df)
-    combined = pd.concat(dfs)
+def combine_metrics(experiment_name, result_dir, partials=False):
+    """Write the experiment results file as a timestamped result csv.
+
+    With `partials` the per-cell `partial-*.csv` files are exported as well.
+    """
+    import_legacy_partials(experiment_name, result_dir)
+    compact_results(experiment_name, result_dir)
+    combined = read_results(experiment_name, result_dir)
     ts_str = datetime.now().strftime("%Y%m%d%H%M%S")
     file_name = f"{result_dir}/{experiment_name}/result-{experiment_name}-{ts_str}.csv"
     Path(file_name).parent.mkdir(parents=True, exist_ok=True)
     combined.to_csv(file_name, index=False)
+    if partials:
+        export_partials(experiment_name, result_dir)
 
 
 def cleanup(model):
@@ -92,13 +115,29 @@ def get_mxq_bits(reduction_pcts=[3, 5, 8]):
 
 
 def _reset_peak_memory_stats():
-    return torch.cuda.reset_peak_memory_stats()
+    # CPU workers of the experiment scheduler have no CUDA device
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
 
 
 def get_memory_metrics():
+    if not torch.cuda.is_available():
+        return 0, 0
     return torch.cuda.max_memory_allocated(), torch.cuda.max_memory_reserved()
 
 
+def get_planning_metrics_files(model_arch):
+    if model_arch == "ViT":
+        model_ids = VIT_OPENCLIP_MODELS.keys()
+    else:
+        model_ids = [
+            key for key in LLAMA_MODELS if LLAMA_MODELS[key].get("experiment", False)
+        ]
+    return {
+        model_id: get_mxq_quant_meta_data_file(model_id)[1] for model_id in model_ids
+    }
+
+
 def plan_eval_bit_budgets(
     model_arch="ViT",
     points=5,
@@ -106,107 +145,69 @@ def plan_eval_bit_budgets(
     bases=[4.51],
     include_base=False,
 ):
-    for base in bases:
-        ideals, solvables = get_eval_plan(model_arch, base, points, step, include_base)
+    plan_bit_budgets(model_arch, [(base, points, step, include_base) for base in bases])
+
+
+def plan_bit_budgets(model_arch, plan, max_workers=None):
+    """Solve the (base, points, step, include_base) `plan` in one parallel run."""
+    fps = get_planning_metrics_files(model_arch)
+    df = plan_budgets(fps, plan, max_workers=max_workers, weight_algo="sensi-milp")
+    for (base, step), grp in df.groupby(["base", "step"], sort=False):
         print("*" * 72)
-        print(f"base: {base}")
-        for t in zip(ideals, solvables):
+        print(f"base: {base}, step: {step}")
+        for t in zip(grp["ideal"], grp["solvable"]):
             print(f"ideal: {t[0]:.2f}, solvable: {t[1]:.2f}")
         print("*" * 72)
+    return df
 
 
 def get_eval_plan(model_arch, base, points, step, include_base):
-    ideals = []
-    solvables = []
-    start = 0 if include_base else 1
-    for point in range(start, points + 1):
-        tentative = round(base + point * step, 2)
-        ideals.append(tentative)
-        ret = try_solvable(model_arch, tentative, step)
-        if ret is not None:
-            solvables.append(ret)
-        else:
-            solvables.append(0.0)
-    return ideals, solvables
+    fps = get_planning_metrics_files(model_arch)
+    df = plan_budgets(
+        fps, [(base, points, step, include_base)], weight_algo="sensi-milp"
+    )
+    return list(df["ideal"]), list(df["solvable"])
 
 
 def try_solvable(model_arch, bit_budget, step):
-    if model_arch == "ViT":
-        model_ids = VIT_OPENCLIP_MODELS.keys()
-    else:
-        model_ids = [
-            key for key in LLAMA_MODELS if LLAMA_MODELS[key].get("experiment", False)
-        ]
-
-    dikt = {}
-    feasible_budget = round(bit_budget, 2)
-    for model_id in model_ids:
-        attempts = 1
-        _, fp = get_mxq_quant_meta_data_file(model_id)
-        while True:
-            try:
-                # find_optimal_configs(fp, feasible_budget, time_limit=200)
-                find_optimal_configs(
-                    fp,
-                    feasible_budget,
-                    time_limit=200,
-                    weight_algo="sensi-milp",
-                )
-                dikt[model_id] = feasible_budget
-                break
-            except ValueError:
-                print(f"Warning: {feasible_budget:.2f} unsolvable for model {model_id}")
-                if attempts > 3:
-                    return None
-                feasible_budget += -0.01 if step < 0 else 0.01
-            attempts += 1
-    if len(set(dikt.values())) > 1:
-        for model_id, budget in dikt.items():
-            if abs(budget - feasible_budget) > 0.01:
-                try:
-                    fp = get_mxq_quant_meta_data_file(model_id)
-                    find_optimal_configs(fp, feasible_budget, time_limit=200)
-                except ValueError:
-                    print(
-                        f"Warning: {feasible_budget:.2f} unsolvable for model {model_id}"
-                    )
-                    return None
+    fps = get_planning_metrics_files(model_arch)
+    # move to the first budget in the direction of `step` that every model
+    # can reach, using the precomputed reachable budgets of each model
+    feasible_budget = snap_common_budget(fps.values(), round(bit_budget, 2), step)
+    if feasible_budget is None:
+        print(f"Warning: no budget beyond {bit_budget:.2f} is reachable")
+        return None
+
+    kwargs = {"weight_algo": "sensi-milp"}
+    for model_id, fp in fps.items():
+        try:
+            solve_mxq(fp, feasible_budget, time_limit=200, **kwargs)
+        except ValueError:
+            print(f"Warning: {feasible_budget:.2f} unsolvable for model {model_id}")
+            return None
     return feasible_budget
 
 
 def debug_milp_solvable(model_id, bit_budget):
     _, fp = get_mxq_quant_meta_data_file(model_id)
-    configs = find_optimal_configs(fp, bit_budget, time_limit=200)
+    configs = solve_mxq(fp, bit_budget, time_limit=200)
     print(configs)
 
 
 def plan_432_bits():
     bases = [4.51, 4.25, 4.13]
-    plan_eval_bit_budgets(
-        model_arch="llm", points=5, step=0.02, bases=bases, include_base=True
-    )
-    plan_eval_bit_budgets(
-        model_arch="llm", points=5, step=-0.02, bases=bases, include_base=True
-    )
+    plan = [(base, 5, step, True) for step in [0.02, -0.02] for base in bases]
     bases = [3.51, 3.25, 3.13, 2.51, 2.25, 2.13]
-    plan_eval_bit_budgets(
-        model_arch="llm", points=3, step=0.02, bases=bases, include_base=True
-    )
-    plan_eval_bit_budgets(
-        model_arch="llm", points=3, step=-0.02, bases=bases, include_base=True
-    )
+    plan.extend((base, 3, step, True) for step in [0.02, -0.02] for base in bases)
+    plan_bit_budgets("llm", plan)
 
 
 def plan_567_bits():
     best_bit_budget = calc_bits(8, 32, 8, 128)
     save_objs = [10, 20, 30, 40]
     bases = [best_bit_budget * (100 - obj) / 100 for obj in save_objs]
-    plan_eval_bit_budgets(
-        model_arch="llm", points=5, step=0.02, bases=bases, include_base=True
-    )
-    plan_eval_bit_budgets(
-        model_arch="llm", points=5, step=-0.02, bases=bases, include_base=True
-    )
+    plan = [(base, 5, step, True) for step in [0.02, -0.02] for base in bases]
+    plan_bit_budgets("llm", plan)
 
 
 def fill_budget_gap(start, stop, step=0.02):
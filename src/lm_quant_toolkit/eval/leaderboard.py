@@ -1,3 +1,4 @@
+import contextlib
 import json
 import os
 import shutil
@@ -6,8 +7,10 @@ from pathlib import Path
 
 import numpy as np
 from lm_eval import evaluator
+from lm_eval.models.huggingface import HFLM
 from lm_eval.tasks import TaskManager
 
+from lm_quant_toolkit.adapter.snapshot import SNAPSHOT_BLOB_DIR, snapshot_store
 from lm_quant_toolkit.utils.hub import get_hf_model_storge_base_dir
 
 HIGHER_IS_BETTER_SYMBOLS = {
@@ -108,43 +111,64 @@ def eval_llm_leaderboard(
     quant_base_dir,
     result_dir,
     verbosity="INFO",
+    model=None,
+    tokenizer=None,
 ):
-    if quantized:
+    """Run the Open LLM Leaderboard tasks with lm_eval and score them.
+
+    A live `model` (and its `tokenizer`) is evaluated in place. Otherwise
+    lm_eval loads the checkpoint or quantized snapshot from disk.
+    """
+    lm = "hf"
+    model_args = None
+    store = contextlib.nullcontext()
+    if model is not None:
+        lm = HFLM(
+            pretrained=model,
+            tokenizer=tokenizer,
+            batch_size="auto:16",
+            max_batch_size=16,
+        )
+    elif quantized:
         quant_dir = os.path.join(
             quant_base_dir, f"{model_id}-{confg_name}-{quant_method.lower()}"
         )
         # prepare the quantized model by copying tokenizer files
         _prepare_tokenizer_files(model_id, quant_dir)
         model_args = f"pretrained={quant_dir},quant_method={quant_method}"
+        if quant_method.lower() in ["hqq", "mxq"]:
+            # the snapshot may reference tensors in the blob store
+            store = snapshot_store(os.path.join(quant_base_dir, SNAPSHOT_BLOB_DIR))
     else:
         model_args = f"pretrained={model_id}"
 
     t1 = time.time()
     task_manager = TaskManager(verbosity)
-    results = evaluator.simple_evaluate(
-        model="hf",
-        model_args=model_args,
-        tasks="leaderboard",
-        # num_fewshot=args.num_fewshot,
-        batch_size="auto:16",
-        max_batch_size=16,
-        device="cuda:0",
-        # use_cache=True,
-        # check_integrity=True,
-        write_out=False,
-        log_samples=True,
-        system_instruction=None,
-        # apply_chat_template=args.apply_chat_template,
-        fewshot_as_multiturn=False,
-        # gen_kwargs=args.gen_kwargs,
-        task_manager=task_manager,
-        verbosity=verbosity,
-        predict_only=False,
-        random_seed=0,
-        numpy_random_seed=1234,
-        torch_random_seed=1234,
-        fewshot_random_seed=1234,
-    )
+    with store:
+        results = evaluator.simple_evaluate(
+            model=lm,
+            model_args=model_args,
+            tasks="leaderboard",
+            # num_fewshot=args.num_fewshot,
+            batch_size="auto:16",
+            max_batch_size=16,
+            device="cuda:0",
+            # use_cache=True,
+            # check_integrity=True,
+            write_out=False,
+            log_samples=True,
+            system_instruction=None,
+            # apply_chat_template=args.apply_chat_template,
+            fewshot_as_multiturn=False,
+            # gen_kwargs=args.gen_kwargs,
+            task_manager=task_manager,
+            verbosity=verbosity,
+            predict_only=False,
+            random_seed=0,
+            numpy_random_seed=1234,
+            torch_random_seed=1234,
+            fewshot_random_seed=1234,
+        )
     t2 = time.time()
 
     if results is not None:
@@ -1,125 +1,327 @@
 import gc
+import math
+import os
+import random
 import time
+from statistics import NormalDist
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from datasets import load_dataset
 from tqdm import tqdm
 
+from lm_quant_toolkit.utils.cache import (
+    cache_key,
+    get_cache_dir,
+    load_tensor,
+    save_tensor,
+)
+from lm_quant_toolkit.utils.calib import tokenizer_fingerprint
+
 
 def cleanup():
     torch.cuda.empty_cache()
     gc.collect()
 
 
-def eval_ptb(model, tokenizer, max_length=1024, stride=512, verbose=True):
-    dataset = load_dataset("ptb_text_only", "penn_treebank", split="test")
+def _load_ptb():
+    return load_dataset("ptb_text_only", "penn_treebank", split="test")
+
+
+def _load_c4():
+    dataset = load_dataset(
+        "allenai/c4",
+        data_files={"validation": "en/c4-validation.00000-of-00008.json.gz"},
+        split="validation",
+        download_mode="reuse_dataset_if_exists",
+    )
+    # pick first 1100
+    return dataset[:1100]
+
+
+def _load_wikitext2():
+    return load_dataset("wikitext", "wikitext-2-raw-v1", split="test")
+
+
+# corpus name -> (loader, text column)
+PPL_CORPORA = {
+    "ptb": (_load_ptb, "sentence"),
+    "C4": (_load_c4, "text"),
+    "wikitext": (_load_wikitext2, "text"),
+}
+
+
+def _setup_tokenizer(tokenizer):
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "right"
+    tokenizer.add_eos_token = False
+
+
+def get_corpus_tokens(tokenizer, corpus, cache_dir=None):
+    """Return the token ids of a PPL corpus as a 1-D int32 tensor.
+
+    The corpus is joined with blank lines and tokenized once per tokenizer
+    fingerprint, later calls memory-map the cached array without loading
+    the dataset.
+    """
+    _setup_tokenizer(tokenizer)
+    loader, text_column = PPL_CORPORA[corpus]
+    key = cache_key(tokenizer_fingerprint(tokenizer), corpus, text_column)
+    fp = os.path.join(get_cache_dir("corpora", cache_dir), f"{key}.npy")
+    if not os.path.exists(fp):
+        dataset = loader()
+        encodings = tokenizer("\n\n".join(dataset[text_column]), return_tensors="pt")
+        save_tensor(fp, encodings["input_ids"][0].to(torch.int32))
+    return load_tensor(fp)
+
+
+def eval_ptb(
+    model,
+    tokenizer,
+    max_length=1024,
+    stride=512,
+    verbose=True,
+    batch_size=4,
+    **kwargs,
+):
     return eval_ppl(
         "ptb",
         model,
         tokenizer,
-        dataset,
-        text_column="sentence",
+        input_ids=get_corpus_tokens(tokenizer, "ptb"),
         max_length=max_length,
         stride=stride,
         verbose=verbose,
+        batch_size=batch_size,
+        **kwargs,
     )
 
 
-def eval_c4(model, tokenizer, max_length=1024, stride=512, verbose=True):
-    dataset = load_dataset(
-        "allenai/c4",
-        data_files={"validation": "en/c4-validation.00000-of-00008.json.gz"},
-        split="validation",
-        download_mode="reuse_dataset_if_exists",
-    )
-    # pick first 1100
-    dataset = dataset[:1100]
+def eval_c4(
+    model,
+    tokenizer,
+    max_length=1024,
+    stride=512,
+    verbose=True,
+    batch_size=4,
+    **kwargs,
+):
     return eval_ppl(
         "C4",
         model,
         tokenizer,
-        dataset,
-        text_column="text",
+        input_ids=get_corpus_tokens(tokenizer, "C4"),
         max_length=max_length,
         stride=stride,
         verbose=verbose,
+        batch_size=batch_size,
+        **kwargs,
     )
 
 
-def eval_wikitext2(model, tokenizer, max_length=1024, stride=512, verbose=True):
-    dataset = load_dataset("wikitext", "wikitext-2-raw-v1", split="test")
+def eval_wikitext2(
+    model,
+    tokenizer,
+    max_length=1024,
+    stride=512,
+    verbose=True,
+    batch_size=4,
+    **kwargs,
+):
     return eval_ppl(
         "wikitext",
         model,
         tokenizer,
-        dataset,
-        text_column="text",
+        input_ids=get_corpus_tokens(tokenizer, "wikitext"),
         max_length=max_length,
         stride=stride,
         verbose=verbose,
+        batch_size=batch_size,
+        **kwargs,
     )
 
 
+def get_ppl_windows(seq_len, max_length=1024, stride=512):
+    """Return the (begin, end, target length) of every sliding window."""
+    windows = []
+    for i in range(0, seq_len, stride):
+        begin_loc = max(i + stride - max_length, 0)
+        end_loc = min(i + stride, seq_len)
+        windows.append((begin_loc, end_loc, end_loc - i))
+    return windows
+
+
+def ppl_confidence_interval(nlls, trg_lens, total_windows, confidence=0.95):
+    """CLT confidence interval of the perplexity estimated from sampled windows.
+
+    The per-token NLL is the ratio sum(nlls) / sum(trg_lens) of the sampled
+    windows. Its standard error uses the linearized ratio estimator with a
+    finite population correction for sampling without replacement.
+    Returns (ppl, low, high).
+    """
+    x = np.asarray(nlls, dtype=np.float64)
+    y = np.asarray(trg_lens, dtype=np.float64)
+    n = len(x)
+    ratio = x.sum() / y.sum()
+    if n < 2:
+        return math.exp(ratio), 0.0, math.inf
+    resid = x - ratio * y
+    fpc = 1 - n / total_windows
+    se = math.sqrt(max(fpc, 0) * resid.var(ddof=1) / n) / y.mean()
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    return math.exp(ratio), math.exp(ratio - z * se), math.exp(ratio + z * se)
+
+
 # Adapted from https://huggingface.co/transformers/v4.2.2/perplexity.html
 def eval_ppl(
     ds_type,
     model,
     tokenizer,
-    dataset,
+    dataset=None,
     text_column="text",
     max_length=1024,
     stride=512,
     verbose=True,
+    batch_size=4,
+    input_ids=None,
+    tolerance=None,
+    confidence=0.95,
+    seed=0,
+    min_windows=32,
+    stats=None,
 ):
-    model.eval()
-    tokenizer.pad_token = tokenizer.eos_token
-    tokenizer.padding_side = "right"
-    tokenizer.add_eos_token = False
+    """Sliding-window perplexity evaluated in micro-batches of `batch_size`.
 
-    encodings = tokenizer("\n\n".join(dataset[text_column]), return_tensors="pt")
+    Every window contributes its mean NLL over the unmasked targets times
+    the target length, exactly like the one-window-at-a-time loop. Windows
+    of a batch are right padded, padding is masked out of attention and loss.
+    Pre-tokenized `input_ids` (see `get_corpus_tokens`) skip tokenization.
+
+    With `tolerance` set, windows are drawn in an order shuffled by `seed`
+    and evaluation stops once the `confidence` interval of the perplexity is
+    within +/- `tolerance` (relative) of the estimate, after at least
+    `min_windows` windows. The interval and number of windows used are
+    written to the `stats` dict if one is given.
+    """
+    model.eval()
+    _setup_tokenizer(tokenizer)
 
-    encodings["input_ids"] = encodings["input_ids"].to("cuda")
+    if input_ids is None:
+        encodings = tokenizer("\n\n".join(dataset[text_column]), return_tensors="pt")
+        input_ids = encodings["input_ids"][0]
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    input_ids = input_ids.to(device).long()
+    seq_len = input_ids.size(0)
+    windows = get_ppl_windows(seq_len, max_length, stride)
+    if tolerance is None:
+        # batch windows of equal length together to avoid padding
+        order = sorted(
+            range(len(windows)), key=lambda k: windows[k][1] - windows[k][0]
+        )
+    else:
+        order = list(range(len(windows)))
+        random.Random(seed).shuffle(order)
 
-    lls, t = [], []
-    for i in tqdm(
-        range(0, encodings["input_ids"].size(1), stride),
+    nll = torch.zeros((), dtype=torch.float64, device=input_ids.device)
+    window_nlls, window_trg_lens = [], []
+    ppl_low, ppl_high = None, None
+    n_windows = 0
+    t1 = time.time()
+    for b in tqdm(
+        range(0, len(order), batch_size),
         desc=ds_type,
         disable=not verbose,
     ):
-        begin_loc = max(i + stride - max_length, 0)
-        end_loc = min(i + stride, encodings["input_ids"].size(1))
-        trg_len = end_loc - i
-        input_ids = encodings["input_ids"][:, begin_loc:end_loc]
-        target_ids = input_ids.clone()
-        target_ids[:, :-trg_len] = -100  # ignore context
+        batch = [windows[k] for k in order[b : b + batch_size]]
+        width = max(end_loc - begin_loc for begin_loc, end_loc, _ in batch)
+        batch_ids = torch.full(
+            (len(batch), width),
+            tokenizer.pad_token_id,
+            dtype=input_ids.dtype,
+            device=input_ids.device,
+        )
+        attention_mask = torch.zeros_like(batch_ids)
+        labels = torch.full_like(batch_ids, -100)
+        for row, (begin_loc, end_loc, trg_len) in enumerate(batch):
+            n = end_loc - begin_loc
+            batch_ids[row, :n] = input_ids[begin_loc:end_loc]
+            attention_mask[row, :n] = 1
+            # ignore context
+            labels[row, n - trg_len : n] = input_ids[end_loc - trg_len : end_loc]
 
-        t1 = time.time()
         with torch.no_grad():
-            log_likelihood = model(input_ids, labels=target_ids).loss * trg_len
-        torch.cuda.synchronize()
-        t2 = time.time()
-        t.append((t2 - t1))
-        lls.append(log_likelihood)
+            logits = model(batch_ids, attention_mask=attention_mask).logits
+            batch_nll = torch.stack(
+                [
+                    F.cross_entropy(
+                        logits[row, :-1].float(), labels[row, 1:], ignore_index=-100
+                    )
+                    * trg_len
+                    for row, (_, _, trg_len) in enumerate(batch)
+                ]
+            )
+            nll += batch_nll.sum()
+        del logits, batch_ids, attention_mask, labels
+        n_windows += len(batch)
 
-        del input_ids, target_ids
+        if tolerance is not None:
+            window_nlls.extend(batch_nll.tolist())
+            window_trg_lens.extend(trg_len for _, _, trg_len in batch)
+            est, ppl_low, ppl_high = ppl_confidence_interval(
+                window_nlls, window_trg_lens, len(windows), confidence
+            )
+            if n_windows >= min_windows and ppl_high - ppl_low <= 2 * tolerance * est:
+                break
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    t2 = time.time()
 
-    ppl = np.round(float(torch.exp(torch.stack(lls).sum() / end_loc)), 4)
-    pred_time = np.round(np.mean(t), 3)
+    if n_windows == len(windows):
+        ppl = np.round(float(torch.exp(nll / seq_len)), 4)
+    else:
+        ppl = np.round(est, 4)
+    # average time per window, comparable with unbatched runs
+    pred_time = np.round((t2 - t1) / n_windows, 3)
     if verbose:
         print(f"{ds_type} perplexity: {ppl}, time: {pred_time} sec")
+        if n_windows < len(windows):
+            print(
+                f"{ds_type} estimated from {n_windows}/{len(windows)} windows, "
+                f"{confidence:.0%} CI: [{ppl_low:.4f}, {ppl_high:.4f}]"
+            )
+    if stats is not None:
+        stats["windows"] = n_windows
+        stats["total_windows"] = len(windows)
+        stats["ppl_low"] = ppl if ppl_low is None else np.round(ppl_low, 4)
+        stats["ppl_high"] = ppl if ppl_high is None else np.round(ppl_high, 4)
 
-    del encodings
+    del input_ids
     cleanup()
 
     return ppl, pred_time
 
 
-def eval_ppls(model, tokenizer, metric):
-    ppl_wikitext, duration_wikitext = eval_wikitext2(model, tokenizer, verbose=True)
-    ppl_c4, duration_c4 = eval_c4(model, tokenizer, verbose=True)
-    metric["ppl_wikitext"] = ppl_wikitext
-    metric["ppl_c4"] = ppl_c4
-    metric["duration_wikitext"] = duration_wikitext
-    metric["duration_c4"] = duration_c4
+def eval_ppls(model, tokenizer, metric, batch_size=4, tolerance=None):
+    """Evaluate wikitext2 and C4 perplexity into `metric`.
+
+    With `tolerance` set, perplexities are early-exit estimates and the
+    confidence interval and number of windows of each corpus are recorded.
+    """
+    for name, eval_fn in [("wikitext", eval_wikitext2), ("c4", eval_c4)]:
+        stats = {}
+        ppl, duration = eval_fn(
+            model,
+            tokenizer,
+            verbose=True,
+            batch_size=batch_size,
+            tolerance=tolerance,
+            stats=stats,
+        )
+        metric[f"ppl_{name}"] = ppl
+        metric[f"duration_{name}"] = duration
+        if tolerance is not None:
+            metric[f"ppl_{name}_low"] = stats["ppl_low"]
+            metric[f"ppl_{name}_high"] = stats["ppl_high"]
+            metric[f"windows_{name}"] = stats["windows"]
     return metric
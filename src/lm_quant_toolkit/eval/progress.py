@@ -0,0 +1,270 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+
+PENDING = "pending"
+CLAIMED = "claimed"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# seconds between lease renewals of the sub-tasks a process owns
+HEARTBEAT_INTERVAL = 60
+# claimed/running sub-tasks without a renewal for this long are requeued
+LEASE_SECONDS = 30 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    experiment TEXT NOT NULL,
+    model TEXT NOT NULL,
+    algo TEXT NOT NULL,
+    cfg TEXT NOT NULL,
+    task_type TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    claimed_at TEXT,
+    started_at TEXT,
+    completion_time TEXT,
+    error TEXT,
+    heartbeat_at REAL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_tasks_key
+    ON tasks (experiment, model, algo, cfg, task_type);
+CREATE INDEX IF NOT EXISTS ix_tasks_state ON tasks (experiment, state);
+"""
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ProgressStore:
+    """SQLite-backed progress of experiment sub-tasks.
+
+    A sub-task is keyed by (experiment, model, algo, cfg, task_type) and moves
+    through pending -> claimed -> running -> done/failed. Every transition is
+    a single conditional UPDATE, so concurrent processes or hosts sharing the
+    database never run the same sub-task twice. Owners renew a lease on
+    their sub-tasks with `heartbeat`, so the sub-tasks of a crashed host can
+    be requeued from any other host.
+    """
+
+    def __init__(self, db_path, timeout=60):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.timeout = timeout
+        self.conn = sqlite3.connect(db_path, timeout=timeout)
+        # WAL needs shared memory, which network filesystems don't provide,
+        # and it sticks to the database file once set
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.executescript(_SCHEMA)
+        self._add_heartbeat_column()
+        self._heartbeat_stop = None
+
+    def _add_heartbeat_column(self):
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(tasks)")]
+        if "heartbeat_at" in columns:
+            return
+        try:
+            with self.conn:
+                self.conn.execute("ALTER TABLE tasks ADD COLUMN heartbeat_at REAL")
+        except sqlite3.OperationalError as e:
+            # another process added it meanwhile
+            if "duplicate column" not in str(e):
+                raise
+
+    def close(self):
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_stop = None
+        self.conn.close()
+
+    def heartbeat(self, experiment, owner=None, conn=None):
+        """Renew the lease of the claimed/running sub-tasks of `owner`."""
+        conn = conn or self.conn
+        with conn:
+            conn.execute(
+                "UPDATE tasks SET heartbeat_at = ? "
+                "WHERE experiment = ? AND owner = ? AND state IN (?, ?)",
+                (time.time(), experiment, owner or get_owner(), CLAIMED, RUNNING),
+            )
+
+    def start_heartbeat(self, experiment, interval=HEARTBEAT_INTERVAL):
+        """Renew the leases of this process every `interval` seconds until closed."""
+        if self._heartbeat_stop is not None:
+            return
+        self._heartbeat_stop = threading.Event()
+        owner = get_owner()
+
+        def _beat(stop):
+            # sqlite connections can't be shared across threads
+            conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            try:
+                while not stop.wait(interval):
+                    try:
+                        self.heartbeat(experiment, owner, conn=conn)
+                    except sqlite3.Error as e:
+                        print(f"Warning: progress heartbeat failed: {e}")
+            finally:
+                conn.close()
+
+        self._heartbeat_thread = threading.Thread(
+            target=_beat, args=(self._heartbeat_stop,), daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    def register(self, experiment, items):
+        """Add sub-tasks from the rows of `items`, existing ones are kept."""
+        rows = [
+            (experiment, row["model"], row["algo"], row["cfg"], row["task_type"])
+            for row in items
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO tasks "
+                "(experiment, model, algo, cfg, task_type) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def migrate_csv(self, experiment, csv_path):
+        """Import the finished sub-tasks of a legacy progress.csv file."""
+        if not os.path.exists(csv_path):
+            return 0
+        df = pd.read_csv(csv_path)
+        df = df[df["status"] == 1]
+        rows = [
+            (
+                str(row["completion_time"]),
+                experiment,
+                row["model"],
+                row["algo"],
+                row["cfg"],
+                row["task_type"],
+            )
+            for _, row in df.iterrows()
+        ]
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE tasks SET state = 'done', completion_time = ? "
+                "WHERE experiment = ? AND model = ? AND algo = ? AND cfg = ? "
+                "AND task_type = ? AND state = 'pending'",
+                rows,
+            )
+        return len(rows)
+
+    def requeue_orphans(self, experiment, lease_seconds=LEASE_SECONDS):
+        """Reset claimed/running sub-tasks whose owner died or lost its lease.
+
+        Owners on this host are checked by pid, owners on any host by the age
+        of their last heartbeat. Returns the number of requeued sub-tasks.
+        """
+        host = socket.gethostname()
+        cur = self.conn.execute(
+            "SELECT owner FROM tasks WHERE experiment = ? AND state IN (?, ?) "
+            "GROUP BY owner",
+            (experiment, CLAIMED, RUNNING),
+        )
+        orphans = []
+        for (owner,) in cur.fetchall():
+            owner_host, _, pid = (owner or "").rpartition(":")
+            if owner_host == host and not _pid_alive(int(pid)):
+                orphans.append(owner)
+        requeued = 0
+        with self.conn:
+            for owner in orphans:
+                cur = self.conn.execute(
+                    "UPDATE tasks SET state = ?, owner = NULL "
+                    "WHERE experiment = ? AND owner = ? AND state IN (?, ?)",
+                    (PENDING, experiment, owner, CLAIMED, RUNNING),
+                )
+                requeued += cur.rowcount
+            cur = self.conn.execute(
+                "UPDATE tasks SET state = ?, owner = NULL "
+                "WHERE experiment = ? AND state IN (?, ?) "
+                "AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                (PENDING, experiment, CLAIMED, RUNNING, time.time() - lease_seconds),
+            )
+            requeued += cur.rowcount
+        return requeued
+
+    def tasks(self, experiment, states=None):
+        sql = "SELECT * FROM tasks WHERE experiment = ?"
+        params = [experiment]
+        if states is not None:
+            sql += f" AND state IN ({', '.join('?' * len(states))})"
+            params.extend(states)
+        return pd.read_sql_query(sql, self.conn, params=params)
+
+    def claim(self, experiment, key, owner=None):
+        """Atomically claim a pending or failed sub-task, False if taken."""
+        with self.conn:
+            cur = self.conn.execute(
+                "UPDATE tasks SET state = ?, owner = ?, claimed_at = ?, error = NULL, "
+                "heartbeat_at = ? "
+                "WHERE experiment = ? AND model = ? AND algo = ? AND cfg = ? "
+                "AND task_type = ? AND state IN (?, ?)",
+                (CLAIMED, owner or get_owner(), _now(), time.time(), experiment, *key)
+                + (PENDING, FAILED),
+            )
+        return cur.rowcount == 1
+
+    def start(self, experiment, key):
+        self._transition(
+            experiment, key, RUNNING, started_at=_now(), heartbeat_at=time.time()
+        )
+
+    def done(self, experiment, key, completion_time=None):
+        self._transition(
+            experiment, key, DONE, completion_time=completion_time or _now()
+        )
+
+    def fail(self, experiment, key, error=None):
+        self._transition(
+            experiment, key, FAILED, completion_time=_now(), error=str(error)
+        )
+
+    def _transition(self, experiment, key, state, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in ["state", *fields])
+        with self.conn:
+            self.conn.execute(
+                f"UPDATE tasks SET {assignments} "
+                "WHERE experiment = ? AND model = ? AND algo = ? AND cfg = ? "
+                "AND task_type = ?",
+                (state, *fields.values(), experiment, *key),
+            )
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def open_progress_store(experiment_name, result_dir, items):
+    """Open the progress store of an experiment and register its sub-tasks.
+
+    Finished sub-tasks of a legacy progress.csv are imported, sub-tasks
+    orphaned by a crashed process or host are requeued and the leases of the
+    sub-tasks this process claims are renewed until the store is closed.
+    """
+    exp_dir = os.path.join(result_dir, experiment_name)
+    store = ProgressStore(os.path.join(exp_dir, "progress.db"))
+    store.register(experiment_name, items)
+    store.migrate_csv(experiment_name, os.path.join(exp_dir, "progress.csv"))
+    store.requeue_orphans(experiment_name)
+    store.start_heartbeat(experiment_name)
+    return store
@@ -0,0 +1,178 @@
+import contextlib
+import fcntl
+import glob
+import json
+import os
+import time
+import uuid
+
+import pandas as pd
+
+from lm_quant_toolkit.utils.cache import atomic_path
+
+RESULTS_FILE = "results.parquet"
+# per-save parquet files not yet compacted into the results file
+FRAGMENTS_DIR = "results-fragments"
+# fragments that trigger a compaction on save
+COMPACT_THRESHOLD = 64
+# one row per evaluated model config
+RESULT_KEY = ["model", "algo", "config"]
+
+
+def get_results_fp(experiment_name, result_dir):
+    return os.path.join(result_dir, experiment_name, RESULTS_FILE)
+
+
+def _get_fragments_dir(experiment_name, result_dir):
+    return os.path.join(result_dir, experiment_name, FRAGMENTS_DIR)
+
+
+def _list_fragments(experiment_name, result_dir):
+    # names start with a timestamp, so they sort in save order
+    return sorted(glob.glob(f"{_get_fragments_dir(experiment_name, result_dir)}/*"))
+
+
+@contextlib.contextmanager
+def _locked(fp, shared=False):
+    os.makedirs(os.path.dirname(fp), exist_ok=True)
+    with open(f"{fp}.lock", "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _to_row(metric):
+    # nested configs (dicts/lists) are kept as their string form, like in csv
+    return {
+        k: str(v) if isinstance(v, (dict, list, tuple)) else v
+        for k, v in metric.items()
+    }
+
+
+def _read_view(experiment_name, result_dir, fragments):
+    fp = get_results_fp(experiment_name, result_dir)
+    dfs = [pd.read_parquet(fp)] if os.path.exists(fp) else []
+    dfs.extend(pd.read_parquet(fragment) for fragment in fragments)
+    dfs = [df for df in dfs if len(df) > 0]
+    if not dfs:
+        return pd.DataFrame()
+    df = pd.concat(dfs, ignore_index=True)
+    # later saves of a key replace earlier ones
+    return df.drop_duplicates(subset=RESULT_KEY, keep="last").reset_index(drop=True)
+
+
+def read_results(experiment_name, result_dir):
+    """Results of an experiment, one row per model, algo and config."""
+    fp = get_results_fp(experiment_name, result_dir)
+    if not os.path.exists(os.path.dirname(fp)):
+        return pd.DataFrame()
+    # compaction removes fragments only under the exclusive lock
+    with _locked(fp, shared=True):
+        fragments = _list_fragments(experiment_name, result_dir)
+        return _read_view(experiment_name, result_dir, fragments)
+
+
+def compact_results(experiment_name, result_dir):
+    """Fold the save fragments of an experiment into its results file."""
+    fp = get_results_fp(experiment_name, result_dir)
+    with _locked(fp):
+        fragments = _list_fragments(experiment_name, result_dir)
+        if not fragments:
+            return 0
+        df = _read_view(experiment_name, result_dir, fragments)
+        with atomic_path(fp) as tmp:
+            df.to_parquet(tmp, index=False)
+        # fragments saved meanwhile are newer and stay
+        for fragment in fragments:
+            os.remove(fragment)
+    return len(fragments)
+
+
+def upsert_results(experiment_name, metrics, result_dir, replace=True):
+    """Insert or replace the rows of `metrics` keyed by model, algo and config.
+
+    Each save appends its rows as a new fragment file, so it costs the same
+    however many results the experiment holds. Readers merge the compacted
+    results file with the fragments, later saves of a key winning, and the
+    fragments are compacted once there are `COMPACT_THRESHOLD` of them.
+    With `replace=False` rows whose key already exists are skipped instead.
+    """
+    df_new = pd.DataFrame([_to_row(metric) for metric in metrics])
+    if not replace:
+        df = read_results(experiment_name, result_dir)
+        if len(df) > 0:
+            old_keys = df.set_index(RESULT_KEY).index
+            df_new = df_new[~df_new.set_index(RESULT_KEY).index.isin(old_keys)]
+    if len(df_new) == 0:
+        return
+    fragments_dir = _get_fragments_dir(experiment_name, result_dir)
+    os.makedirs(fragments_dir, exist_ok=True)
+    name = f"{time.time_ns():020d}-{os.getpid()}-{uuid.uuid4().hex[:8]}.parquet"
+    with atomic_path(os.path.join(fragments_dir, name)) as tmp:
+        df_new.to_parquet(tmp, index=False)
+    if len(_list_fragments(experiment_name, result_dir)) >= COMPACT_THRESHOLD:
+        compact_results(experiment_name, result_dir)
+
+
+def _get_imported_fp(experiment_name, result_dir):
+    return os.path.join(result_dir, experiment_name, "partials-imported.json")
+
+
+def _read_imported(experiment_name, result_dir):
+    fp = _get_imported_fp(experiment_name, result_dir)
+    if not os.path.exists(fp):
+        return set()
+    with open(fp, "r") as fh:
+        return set(json.load(fh))
+
+
+def _write_imported(experiment_name, result_dir, seen):
+    fp = _get_imported_fp(experiment_name, result_dir)
+    with atomic_path(fp) as tmp, open(tmp, "w") as fh:
+        json.dump(sorted(seen), fh)
+
+
+def import_legacy_partials(experiment_name, result_dir):
+    """Fold `partial-*.csv` files of older runs into the results file once.
+
+    Imported file names are remembered next to the results file, so later
+    calls only read partials that are new.
+    """
+    exp_dir = os.path.join(result_dir, experiment_name)
+    seen = _read_imported(experiment_name, result_dir)
+    new_fps = sorted(
+        fp
+        for fp in glob.iglob(f"{exp_dir}/partial-*.csv")
+        if os.path.basename(fp) not in seen
+    )
+    if not new_fps:
+        return 0
+    metrics = [row for fp in new_fps for row in pd.read_csv(fp).to_dict("records")]
+    # rows saved to the results file directly are newer than any partial
+    upsert_results(experiment_name, metrics, result_dir, replace=False)
+    seen.update(os.path.basename(fp) for fp in new_fps)
+    _write_imported(experiment_name, result_dir, seen)
+    return len(new_fps)
+
+
+def export_partials(experiment_name, result_dir):
+    """Write every result row as `partial-<algo>-<model>-<config>.csv`.
+
+    Compatibility export for tools that read the per-cell csv files of older
+    runs. The exported files are marked as imported, so they are never folded
+    back over newer results.
+    """
+    df = read_results(experiment_name, result_dir)
+    exp_dir = os.path.join(result_dir, experiment_name)
+    names = []
+    for _, row in df.iterrows():
+        name = f"partial-{row['algo']}-{row['model']}-{row['config']}.csv"
+        with atomic_path(os.path.join(exp_dir, name)) as tmp:
+            row.dropna().to_frame().T.to_csv(tmp, index=False)
+        names.append(name)
+    if names:
+        seen = _read_imported(experiment_name, result_dir)
+        _write_imported(experiment_name, result_dir, seen | set(names))
+    return len(names)
@@ -0,0 +1,225 @@
+import contextlib
+import multiprocessing as mp
+import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+from lm_quant_toolkit.adapter.common import get_model_storage_size
+from lm_quant_toolkit.utils.hub import get_hf_model_storge_base_dir
+
+# peak memory of loading/quantizing relative to the fp16 checkpoint size
+FOOTPRINT_FACTOR = 1.2
+
+
+@contextlib.contextmanager
+def _environ(**env):
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _init_worker(num_threads):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def get_device_memory(device):
+    """Total memory in bytes of `device` ("cuda:N" or "cpu").
+
+    Call it in the worker bound to the device, the parent never touches CUDA.
+    """
+    if device.startswith("cuda"):
+        index = int(device.split(":")[1]) if ":" in device else 0
+        return torch.cuda.get_device_properties(index).total_memory
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def get_default_devices():
+    if torch.cuda.is_available():
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+def estimate_footprint(model_id):
+    """Estimated peak memory in bytes of one task on `model_id`, 0 if unknown."""
+    try:
+        base_dir = get_hf_model_storge_base_dir(model_id)
+        return int(get_model_storage_size(base_dir) * FOOTPRINT_FACTOR)
+    except (OSError, ValueError):
+        return 0
+
+
+class ExperimentScheduler:
+    """Run jobs on a pool of single-process workers pinned to devices.
+
+    Every device in `devices` ("cuda:N" or "cpu") gets `workers_per_device`
+    workers. A CUDA worker only sees its own GPU as `cuda:0`, a CPU worker
+    sees no GPU; the mask is set before the worker process starts. A job is
+    admitted to an idle worker only when its estimated footprint fits into
+    the memory its device has left, except when the device is otherwise idle
+    so oversized jobs still make progress.
+    """
+
+    def __init__(self, devices=None, workers_per_device=1, mem_fraction=0.9):
+        self.devices = devices or get_default_devices()
+        n_cpu_workers = sum(
+            workers_per_device for device in self.devices if device == "cpu"
+        )
+        self.cpu_threads = max(1, (os.cpu_count() or 1) // max(1, n_cpu_workers))
+        self.workers = []
+        self.capacity = {}
+        for device in self.devices:
+            for _ in range(workers_per_device):
+                executor, memory = self._start_worker(device)
+                self.capacity.setdefault(device, int(memory * mem_fraction))
+                self.workers.append((device, executor))
+
+    def _start_worker(self, device):
+        """Spawn a single-process pool for `device`, return it and its memory."""
+        if device.startswith("cuda"):
+            visible = device.split(":")[1] if ":" in device else "0"
+            local_device = "cuda:0"
+            num_threads = 0
+        else:
+            visible = ""
+            local_device = "cpu"
+            num_threads = self.cpu_threads
+        executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(num_threads,),
+        )
+        # the mask must be in the environment the worker starts with,
+        # importing __main__ in the child may already initialize CUDA
+        with _environ(CUDA_VISIBLE_DEVICES=visible):
+            memory = executor.submit(get_device_memory, local_device).result()
+        return executor, memory
+
+    def _restart_worker(self, worker):
+        """Replace the broken pool of `worker`, False if that fails too."""
+        device, executor = self.workers[worker]
+        executor.shutdown(wait=False, cancel_futures=True)
+        try:
+            executor, _ = self._start_worker(device)
+        except Exception as e:
+            print(f"Worker on {device} could not be restarted: {e}")
+            executor = None
+        self.workers[worker] = (device, executor)
+        return executor is not None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def shutdown(self):
+        for _, executor in self.workers:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def run(self, jobs, on_done, on_error=None, on_start=None):
+        """Run `jobs` and call `on_done(key, result)` as each one completes.
+
+        `jobs` is a list of (key, footprint, fn, args) tuples, admitted in
+        order. `on_start(key, args)` is called when a job is dispatched and
+        returns the (key, args) to submit, or None to skip the job. Failed
+        jobs are reported to `on_error(key, exc)` (or printed) and do not
+        stop the others. A worker whose process died is replaced by a new
+        one on the same device.
+        """
+        pending = list(jobs)
+        used = {device: 0 for device in self.devices}
+        idle = list(range(len(self.workers)))
+        running = {}
+        while pending or running:
+            for worker in list(idle):
+                submitted = self._dispatch(worker, pending, used, on_start, on_error)
+                if self.workers[worker][1] is None:
+                    # the worker died and could not be restarted
+                    idle.remove(worker)
+                if submitted is None:
+                    continue
+                future, key, footprint = submitted
+                running[future] = (worker, key, footprint)
+                idle.remove(worker)
+            if not running:
+                if not pending:
+                    break
+                # nothing fits, the remaining jobs exceed every device
+                error = "no device fits the job" if idle else "no worker left"
+                key, _, _, _ = pending.pop(0)
+                self._report(on_error, key, MemoryError(error))
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                worker, key, footprint = running.pop(future)
+                device, _ = self.workers[worker]
+                used[device] -= footprint
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    # a hard crash (CUDA abort, segfault) kills the worker
+                    self._report(on_error, key, e)
+                    if not self._restart_worker(worker):
+                        continue
+                except Exception as e:
+                    self._report(on_error, key, e)
+                else:
+                    on_done(key, result)
+                idle.append(worker)
+
+    def _dispatch(self, worker, pending, used, on_start, on_error):
+        """Submit the next admissible job to `worker`.
+
+        Returns (future, key, footprint), or None if no job is left for it.
+        """
+        device, _ = self.workers[worker]
+        while self.workers[worker][1] is not None:
+            job = self._admit(pending, device, used)
+            if job is None:
+                return None
+            key, footprint, fn, args = job
+            if on_start is not None:
+                started = on_start(key, args)
+                if started is None:
+                    continue
+                key, args = started
+            try:
+                future = self.workers[worker][1].submit(fn, *args)
+            except BrokenProcessPool as e:
+                self._report(on_error, key, e)
+                self._restart_worker(worker)
+                continue
+            except Exception as e:
+                self._report(on_error, key, e)
+                continue
+            used[device] += footprint
+            return future, key, footprint
+        return None
+
+    def _admit(self, pending, device, used):
+        for i, job in enumerate(pending):
+            footprint = job[1]
+            if used[device] == 0 or used[device] + footprint <= self.capacity[device]:
+                return pending.pop(i)
+        return None
+
+    @staticmethod
+    def _report(on_error, key, exc):
+        if on_error is not None:
+            on_error(key, exc)
+        else:
+            print(f"Task {key} failed: {exc}")
+            traceback.print_exception(exc)
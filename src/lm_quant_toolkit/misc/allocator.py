@@ -0,0 +1,231 @@
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from lm_quant_toolkit.misc.frontier import CONFIG_COLS, frontier_configs, get_frontier
+from lm_quant_toolkit.misc.solver import get_metrics_digest, solve_mxq
+from lm_quant_toolkit.utils.cache import atomic_path, cache_key, get_cache_dir
+
+ALLOCATORS = ["milp", "greedy", "hier"]
+# MXQ options only the quantizer's own MILP implements
+MILP_ONLY_OPTIONS = [
+    "boost_layers",
+    "decline_layers",
+    "boost_stop",
+    "decline_stop",
+    "ablation",
+]
+
+
+def check_allocator_options(allocator, **options):
+    """Raise ValueError for MXQ `options` the `allocator` can't honour.
+
+    Non-MILP allocators pin the quantizer to one option per module, which
+    leaves nothing for layer boosting, declining or ablation to act on.
+    The greedy allocator minimizes the plain fnorm, so a `weight_algo`
+    (and the `factor` it scales by) would be dropped.
+    """
+    if allocator == "milp":
+        return
+    used = [opt for opt in MILP_ONLY_OPTIONS if options.get(opt, None)]
+    if used:
+        raise ValueError(
+            f"allocator {allocator} doesn't support {', '.join(used)}, use milp"
+        )
+    if allocator == "greedy" and options.get("weight_algo", None):
+        raise ValueError(
+            "greedy allocator minimizes the plain fnorm, "
+            "use milp or hier for weight_algo and factor"
+        )
+
+
+def _load_options(fp):
+    df = pd.read_csv(fp)
+    total_params = df.groupby(["layer", "module"])["params"].first().sum()
+    options = {}
+    for row in df.itertuples():
+        key = f"{row.layer}.{row.module}"
+        cfg = tuple(int(getattr(row, c)) for c in CONFIG_COLS)
+        options.setdefault(key, {})[cfg] = (row.memmb, row.fnorm)
+    return options, total_params
+
+
+def evaluate_configs(fp, configs):
+    """Total (memmb, fnorm) of a per-module config allocation."""
+    options, _ = _load_options(fp)
+    memmb = fnorm = 0
+    for key, cfg in configs.items():
+        m, f = options[key][tuple(cfg)]
+        memmb += m
+        fnorm += f
+    return memmb, fnorm
+
+
+def greedy_allocate(fp, budget):
+    """Allocate per-module configs within `budget` bpp without the MILP.
+
+    Starts from the Lagrangian frontier point within the budget and spends
+    the memory left over on the upgrades with the largest fnorm reduction
+    that still fit. Returns (configs, objective) like `solve_mxq`, the
+    objective being the plain fnorm total. Raises ValueError if the budget
+    is below the smallest achievable bpp.
+    """
+    configs = frontier_configs(get_frontier(fp), budget)
+    if configs is None:
+        raise ValueError(f"budget {budget:.2f} is below the minimum bpp")
+    options, total_params = _load_options(fp)
+    limit = budget * total_params / 8 / 1024**2
+    return _fill_slack(options, configs, limit)
+
+
+def _fill_slack(options, configs, limit):
+    # spend the memory left under `limit` on the largest fnorm reductions
+    memmb = sum(options[k][c][0] for k, c in configs.items())
+    while True:
+        best = None
+        for key, opts in options.items():
+            m0, f0 = opts[configs[key]]
+            for cfg, (m, f) in opts.items():
+                if f < f0 and memmb + m - m0 <= limit:
+                    if best is None or f0 - f > best[0]:
+                        best = (f0 - f, key, cfg, m - m0)
+        if best is None:
+            break
+        _, key, cfg, dmem = best
+        configs[key] = cfg
+        memmb += dmem
+    objective = sum(options[k][c][1] for k, c in configs.items())
+    return configs, objective
+
+
+def _split_blocks(fp, block_layers, cache_dir):
+    df = pd.read_csv(fp)
+    layers = sorted(df["layer"].unique())
+    digest = get_metrics_digest(fp)
+    input_dir = get_cache_dir("solver-input", cache_dir)
+    blocks = []
+    for i in range(0, len(layers), block_layers):
+        block = df[df["layer"].isin(layers[i : i + block_layers])]
+        block_fp = os.path.join(input_dir, f"{digest}-b{block_layers}-{i}.csv")
+        if not os.path.exists(block_fp):
+            with atomic_path(block_fp) as tmp:
+                block.to_csv(tmp, index=False)
+        params = block.groupby(["layer", "module"])["params"].first().sum()
+        keys = {f"{r.layer}.{r.module}" for r in block.itertuples()}
+        blocks.append((block_fp, params, keys))
+    return blocks
+
+
+def hier_allocate(
+    fp,
+    budget,
+    block_layers=8,
+    time_limit=60,
+    max_workers=None,
+    refine=True,
+    cache_dir=None,
+    **kwargs,
+):
+    """Two-level allocation for models too large for a single MILP.
+
+    The coarse level splits the memory budget across blocks of
+    `block_layers` consecutive layers as the Lagrangian frontier point does,
+    handing out the leftover memory by block size. The fine level solves
+    one MILP per block in parallel processes, falling back to the greedy
+    allocator for blocks the MILP can't solve. With `refine` the memory the
+    blocks leave unused is spent greedily across block boundaries. Returns
+    (configs, objective) with the plain fnorm total as objective.
+    """
+    coarse = frontier_configs(get_frontier(fp, cache_dir), budget)
+    if coarse is None:
+        raise ValueError(f"budget {budget:.2f} is below the minimum bpp")
+    options, total_params = _load_options(fp)
+    limit = budget * total_params / 8 / 1024**2
+    used = sum(options[k][c][0] for k, c in coarse.items())
+    blocks = _split_blocks(fp, block_layers, cache_dir)
+
+    block_budgets = []
+    for _, params, keys in blocks:
+        memmb = sum(options[k][coarse[k]][0] for k in keys)
+        memmb += (limit - used) * params / total_params
+        block_budgets.append(memmb * 8 * 1024**2 / params)
+
+    configs = {}
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+        futures = [
+            executor.submit(
+                solve_mxq,
+                block_fp,
+                block_budget,
+                time_limit=time_limit,
+                cache_dir=cache_dir,
+                **kwargs,
+            )
+            for (block_fp, _, _), block_budget in zip(blocks, block_budgets)
+        ]
+        for (block_fp, _, keys), block_budget, future in zip(
+            blocks, block_budgets, futures
+        ):
+            try:
+                block_configs, _ = future.result()
+            except ValueError:
+                print(f"Warning: block {block_fp} unsolvable, using greedy")
+                block_configs, _ = greedy_allocate(block_fp, block_budget)
+            configs.update({k: tuple(v) for k, v in block_configs.items()})
+
+    if refine:
+        return _fill_slack(options, configs, limit)
+    objective = sum(options[k][c][1] for k, c in configs.items())
+    return configs, objective
+
+
+def allocate(fp, budget, allocator="milp", time_limit=200, **kwargs):
+    """Per-module configs within `budget` from the chosen `allocator`."""
+    check_allocator_options(allocator, **kwargs)
+    if allocator == "greedy":
+        return greedy_allocate(fp, budget)
+    if allocator == "hier":
+        return hier_allocate(fp, budget, **kwargs)
+    return solve_mxq(fp, budget, time_limit=time_limit, **kwargs)
+
+
+def get_allocation_metrics_file(fp, budget, allocator, cache_dir=None, **kwargs):
+    """Metrics file pinned to the allocation of `allocator` at `budget`.
+
+    Only the chosen option of every module is kept, so the MXQ quantizer,
+    which solves its own MILP over `quant_metrics_file`, reproduces the
+    allocation as the only solution.
+    """
+    key = cache_key(get_metrics_digest(fp), round(budget, 6), allocator, kwargs)
+    pinned_fp = os.path.join(get_cache_dir("allocations", cache_dir), f"{key}.csv")
+    if os.path.exists(pinned_fp):
+        return pinned_fp
+    configs, _ = allocate(fp, budget, allocator=allocator, **kwargs)
+    df = pd.read_csv(fp)
+    chosen = [
+        tuple(int(getattr(row, c)) for c in CONFIG_COLS)
+        == configs[f"{row.layer}.{row.module}"]
+        for row in df.itertuples()
+    ]
+    with atomic_path(pinned_fp) as tmp:
+        df[chosen].to_csv(tmp, index=False)
+    return pinned_fp
+
+
+def allocation_gap(fp, budget, configs, time_limit=200, **kwargs):
+    """Compare the allocation `configs` against the MILP at `budget`.
+
+    Both allocations are scored by their plain fnorm total, so the gap is
+    meaningful for weighted MILP objectives too.
+    """
+    milp, _ = solve_mxq(fp, budget, time_limit=time_limit, **kwargs)
+    _, fnorm = evaluate_configs(fp, configs)
+    _, milp_fnorm = evaluate_configs(fp, milp)
+    return {
+        "fnorm": fnorm,
+        "milp_fnorm": milp_fnorm,
+        "gap": (fnorm - milp_fnorm) / milp_fnorm,
+    }
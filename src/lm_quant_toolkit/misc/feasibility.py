@@ -0,0 +1,100 @@
+import bisect
+import functools
+import math
+
+import pandas as pd
+
+from lm_quant_toolkit.misc.solver import get_metrics_digest
+
+# granularity of the reachability DP in bits per parameter
+BPP_UNIT = 1e-5
+
+
+def load_module_options(fp):
+    """Return the per-module options of a quant metrics (fnorm) file.
+
+    Each module maps to the sorted list of its distinct contributions to the
+    model-wide bits per parameter, i.e. option bpp weighted by the share of
+    the module in the total parameter count.
+    """
+    df = pd.read_csv(fp)
+    params = df.groupby(["layer", "module"])["params"].first()
+    total_params = params.sum()
+    df["contrib"] = df["memmb"] * 8 * 1024**2 / total_params
+    return {
+        key: sorted(set(grp["contrib"].round(12)))
+        for key, grp in df.groupby(["layer", "module"])
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def _analyze(digest, fp, resolution, tolerance):
+    options = load_module_options(fp)
+    min_bpp = sum(opts[0] for opts in options.values())
+    max_bpp = sum(opts[-1] for opts in options.values())
+
+    # bitset DP over the total in units of BPP_UNIT, bit i set means a
+    # combination of options sums to i units
+    reachable = 1
+    for opts in options.values():
+        units = sorted({round(c / BPP_UNIT) for c in opts})
+        shifted = 0
+        for u in units:
+            shifted |= reachable << u
+        reachable = shifted
+    bits = bin(reachable)[:1:-1]
+    totals = [i * BPP_UNIT for i, bit in enumerate(bits) if bit == "1"]
+
+    # a grid budget is reachable if some allocation lands in (b - tol, b]
+    budgets = []
+    lo = math.floor(min_bpp / resolution)
+    hi = math.ceil((max_bpp + tolerance) / resolution)
+    for i in range(lo, hi + 1):
+        budget = round(i * resolution, 6)
+        j = bisect.bisect_right(totals, budget + BPP_UNIT / 2)
+        if j > 0 and totals[j - 1] > budget - tolerance:
+            budgets.append(budget)
+    return min_bpp, max_bpp, budgets
+
+
+def analyze_budget_range(fp, resolution=0.01, tolerance=0.01):
+    """Achievable bits-per-parameter range of the model behind metrics `fp`.
+
+    Returns a dict with the exact `min_bpp` and `max_bpp` over all module
+    option combinations and `budgets`, the sorted budgets on a `resolution`
+    grid for which some combination uses between `budget - tolerance` and
+    `budget` bpp. Results are memoized by the content of `fp`.
+    """
+    min_bpp, max_bpp, budgets = _analyze(
+        get_metrics_digest(fp), fp, resolution, tolerance
+    )
+    return {"min_bpp": min_bpp, "max_bpp": max_bpp, "budgets": budgets}
+
+
+def snap_budget(fp, budget, step=0.01, resolution=0.01, tolerance=0.01):
+    """Nearest reachable budget at or beyond `budget` in the direction of `step`.
+
+    Returns None when no reachable budget lies in that direction.
+    """
+    budgets = analyze_budget_range(fp, resolution, tolerance)["budgets"]
+    budget = round(budget, 6)
+    if step < 0:
+        i = bisect.bisect_right(budgets, budget)
+        return budgets[i - 1] if i > 0 else None
+    i = bisect.bisect_left(budgets, budget)
+    return budgets[i] if i < len(budgets) else None
+
+
+def snap_common_budget(fps, budget, step=0.01, resolution=0.01, tolerance=0.01):
+    """First budget from `budget` in the direction of `step` all `fps` reach.
+
+    Returns None when some metrics file has no reachable budget left in that
+    direction.
+    """
+    while True:
+        snapped = {snap_budget(fp, budget, step, resolution, tolerance) for fp in fps}
+        if None in snapped:
+            return None
+        if len(snapped) == 1:
+            return snapped.pop()
+        budget = min(snapped) if step < 0 else max(snapped)
@@ -0,0 +1,122 @@
+import os
+
+import pandas as pd
+
+from lm_quant_toolkit.misc.solver import get_metrics_digest
+from lm_quant_toolkit.utils.cache import atomic_path, get_cache_dir
+
+CONFIG_COLS = ["nbit1", "gsize1", "nbit2", "gsize2"]
+
+
+def _lower_hull(points):
+    """Lower convex hull of (memmb, fnorm, config) points, memmb ascending.
+
+    Dominated points (more memory, no less fnorm) are dropped first, so
+    fnorm strictly decreases along the hull.
+    """
+    points = sorted(points, key=lambda p: (p[0], p[1]))
+    frontier = []
+    for p in points:
+        if frontier and p[1] >= frontier[-1][1]:
+            continue
+        frontier.append(p)
+    hull = []
+    for p in frontier:
+        while len(hull) >= 2:
+            (m1, f1, _), (m2, f2, _) = hull[-2], hull[-1]
+            # drop the middle point if it lies on or above the chord
+            if (f2 - f1) * (p[0] - m1) >= (p[1] - f1) * (m2 - m1):
+                hull.pop()
+            else:
+                break
+        hull.append(p)
+    return hull
+
+
+def compute_frontier(fp):
+    """Trace the fnorm-vs-bpp Pareto frontier of metrics file `fp` in one pass.
+
+    Every module starts at its smallest option and is upgraded along the
+    lower convex hull of its (memmb, fnorm) options. Merging the upgrades of
+    all modules by fnorm saved per extra MB yields the Lagrangian solutions
+    for every multiplier at once. The table has one step-0 row per module
+    holding its base config and one row per upgrade after that; `memmb`,
+    `bpp` and `fnorm` are the model totals after the row is applied.
+    """
+    df = pd.read_csv(fp)
+    total_params = df.groupby(["layer", "module"])["params"].first().sum()
+    hulls = {}
+    for (layer, module), grp in df.groupby(["layer", "module"]):
+        points = [
+            (row.memmb, row.fnorm, tuple(int(getattr(row, c)) for c in CONFIG_COLS))
+            for row in grp.itertuples()
+        ]
+        hulls[(layer, module)] = _lower_hull(points)
+
+    upgrades = []
+    for key, hull in hulls.items():
+        for i in range(1, len(hull)):
+            (m0, f0, _), (m1, f1, cfg) = hull[i - 1], hull[i]
+            upgrades.append(((f0 - f1) / (m1 - m0), key, i, m1 - m0, f1 - f0, cfg))
+    # convexity keeps the upgrades of each module in hull order
+    upgrades.sort(key=lambda u: (-u[0], u[1], u[2]))
+
+    memmb = sum(hull[0][0] for hull in hulls.values())
+    fnorm = sum(hull[0][1] for hull in hulls.values())
+    rows = []
+    for (layer, module), hull in hulls.items():
+        rows.append([0, layer, module, *hull[0][2], memmb, fnorm])
+    for step, (_, (layer, module), _, dmem, dfnorm, cfg) in enumerate(upgrades, 1):
+        memmb += dmem
+        fnorm += dfnorm
+        rows.append([step, layer, module, *cfg, memmb, fnorm])
+    frontier = pd.DataFrame(
+        rows, columns=["step", "layer", "module", *CONFIG_COLS, "memmb", "fnorm"]
+    )
+    frontier["bpp"] = frontier["memmb"] * 8 * 1024**2 / total_params
+    return frontier
+
+
+def get_frontier(fp, cache_dir=None):
+    """`compute_frontier` cached on disk by the content of `fp`."""
+    cache_fp = os.path.join(
+        get_cache_dir("frontier", cache_dir), f"{get_metrics_digest(fp)}.csv"
+    )
+    if os.path.exists(cache_fp):
+        return pd.read_csv(cache_fp)
+    frontier = compute_frontier(fp)
+    with atomic_path(cache_fp) as tmp:
+        frontier.to_csv(tmp, index=False)
+    return frontier
+
+
+def _prefix(frontier, budget):
+    base = frontier["step"] == 0
+    if frontier.loc[base, "bpp"].iloc[0] > budget + 1e-9:
+        return None
+    return frontier[base | (frontier["bpp"] <= budget + 1e-9)]
+
+
+def frontier_objective(frontier, budget):
+    """Total fnorm of the frontier point within `budget`, None if unreachable."""
+    prefix = _prefix(frontier, budget)
+    if prefix is None:
+        return None
+    return prefix["fnorm"].iloc[-1]
+
+
+def frontier_configs(frontier, budget):
+    """Per-module configs of the frontier point within `budget`.
+
+    Returns a dict of "layer.module" to (b1, g1, b2, g2) like `solve_mxq`,
+    or None if `budget` is below the smallest achievable bpp.
+    """
+    prefix = _prefix(frontier, budget)
+    if prefix is None:
+        return None
+    configs = {}
+    for row in prefix.itertuples():
+        configs[f"{row.layer}.{row.module}"] = tuple(
+            int(getattr(row, c)) for c in CONFIG_COLS
+        )
+    return configs
@@ -0,0 +1,100 @@
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from lm_quant_toolkit.misc.feasibility import snap_common_budget
+from lm_quant_toolkit.misc.solver import solve_mxq
+
+
+def _solve(fp, budget, time_limit, kwargs):
+    try:
+        _, objective = solve_mxq(fp, budget, time_limit=time_limit, **kwargs)
+        return float(objective)
+    except ValueError:
+        return None
+
+
+def plan_budgets(fps, plan, max_workers=None, max_attempts=4, time_limit=200, **kwargs):
+    """Find solvable MXQ budgets for every point of `plan` in parallel.
+
+    `fps` maps model ids to their quant metrics files and `plan` is a list
+    of (base, points, step, include_base) tuples. Each ideal budget is
+    snapped to the first budget in the direction of its step that all
+    models can reach, then the (model, budget) MILPs of all points are
+    solved on a process pool as one batch. Points with an unsolvable model
+    move on to the next common budget, up to `max_attempts` times, so every
+    solvable budget holds for all models. Returns a DataFrame with base,
+    step, ideal and solvable (0.0 if none) plus the objective per model.
+    Solver jobs that fail for other reasons than infeasibility are reported
+    in the error column of the points they belong to.
+    """
+    rows = []
+    for base, points, step, include_base in plan:
+        for point in range(0 if include_base else 1, points + 1):
+            ideal = round(base + point * step, 2)
+            rows.append(
+                {
+                    "base": base,
+                    "step": step,
+                    "ideal": ideal,
+                    "candidate": snap_common_budget(fps.values(), ideal, step),
+                    "attempts": 1,
+                }
+            )
+
+    results = {}
+    errors = {}
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+        unresolved = rows
+        while unresolved:
+            jobs = {
+                (model_id, row["candidate"])
+                for row in unresolved
+                if row["candidate"] is not None
+                for model_id in fps
+            }
+            futures = {}
+            for model_id, budget in jobs - results.keys():
+                args = (fps[model_id], budget, time_limit, kwargs)
+                futures[executor.submit(_solve, *args)] = (model_id, budget)
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    results[job] = future.result()
+                except Exception as e:
+                    print(f"Warning: solving {job[0]} at {job[1]:.2f} failed: {e}")
+                    results[job] = None
+                    errors[job] = f"{type(e).__name__}: {e}"
+
+            retry = []
+            for row in unresolved:
+                budget = row["candidate"]
+                if budget is None:
+                    row["solvable"] = 0.0
+                    continue
+                objectives = {m: results[(m, budget)] for m in fps}
+                failed = [errors[(m, budget)] for m in fps if (m, budget) in errors]
+                if failed:
+                    row["solvable"] = 0.0
+                    row["error"] = "; ".join(failed)
+                elif None not in objectives.values():
+                    row["solvable"] = budget
+                    row.update(
+                        {f"obj-{m.split('/')[1]}": o for m, o in objectives.items()}
+                    )
+                elif row["attempts"] >= max_attempts:
+                    print(f"Warning: no solvable budget near {row['ideal']:.2f}")
+                    row["solvable"] = 0.0
+                else:
+                    nudge = -0.01 if row["step"] < 0 else 0.01
+                    row["candidate"] = snap_common_budget(
+                        fps.values(), round(budget + nudge, 2), row["step"]
+                    )
+                    row["attempts"] += 1
+                    retry.append(row)
+            unresolved = retry
+
+    df = pd.DataFrame(rows)
+    return df.drop(columns=["candidate", "attempts"])
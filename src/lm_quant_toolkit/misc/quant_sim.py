@@ -1,21 +1,49 @@
+import time
+
 import pandas as pd
-from hqq.utils.optimizer import find_optimal_configs
 
 from lm_quant_toolkit.eval.common import get_mxq_quant_meta_data_file
+from lm_quant_toolkit.misc.allocator import (
+    allocate,
+    allocation_gap,
+    check_allocator_options,
+)
+from lm_quant_toolkit.misc.frontier import frontier_objective, get_frontier
+from lm_quant_toolkit.misc.solver import solve_mxq
+
 
+def dump_mxq_objectives(
+    model_ids, bit_budgets, csv_fp="mxq-objectives.csv", frontier=False
+):
+    """Dump the total fnorm of the best allocation of each model per budget.
 
-def dump_mxq_objectives(model_ids, bit_budgets, csv_fp="mxq-objectives.csv"):
+    One MILP is solved per budget and its optimum written as `fnorm`. With
+    `frontier` the values are read off the fnorm-vs-bpp frontier instead,
+    one pass per model. They bound the MILP optimum from above and are
+    written as `fnorm_ub`.
+    """
+    column = "fnorm_ub" if frontier else "fnorm"
     dikt = []
     for model_id in model_ids:
         short_id = model_id.split("/")[1]
         _, fp = get_mxq_quant_meta_data_file(model_id)
+        df_frontier = get_frontier(fp) if frontier else None
         for bit_budget in bit_budgets:
-            _, objective = find_optimal_configs(fp, bit_budget, time_limit=200)
+            if frontier:
+                objective = frontier_objective(df_frontier, bit_budget)
+            else:
+                try:
+                    _, objective = solve_mxq(fp, bit_budget, time_limit=200)
+                except ValueError:
+                    objective = None
+            if objective is None:
+                print(f"Warning: {bit_budget:.2f} unsolvable for model {model_id}")
+                continue
             dikt.append(
                 {
                     "model": short_id,
                     "bpp": bit_budget,
-                    "fnorm": objective,
+                    column: objective,
                 }
             )
 
@@ -23,7 +51,28 @@ def dump_mxq_objectives(model_ids, bit_budgets, csv_fp="mxq-objectives.csv"):
     df.to_csv(csv_fp, index=False)
 
 
-def dump_mxq_configs(model_ids, bit_budgets, csv_fp, weight_algo, factor):
+def dump_mxq_frontier(model_ids, csv_fp="mxq-frontier.csv"):
+    dfs = []
+    for model_id in model_ids:
+        _, fp = get_mxq_quant_meta_data_file(model_id)
+        df = get_frontier(fp)
+        df.insert(0, "model", model_id.split("/")[1])
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    df.to_csv(csv_fp, index=False)
+
+
+def dump_mxq_configs(
+    model_ids,
+    bit_budgets,
+    csv_fp,
+    weight_algo,
+    factor,
+    allocator="milp",
+    report_gap=False,
+):
+    # raise before the per-budget loop reports it as unsolvable
+    check_allocator_options(allocator, weight_algo=weight_algo, factor=factor)
     dikt = []
     for model_id in model_ids:
         short_id = model_id.split("/")[1]
@@ -31,12 +80,20 @@ def dump_mxq_configs(model_ids, bit_budgets, csv_fp, weight_algo, factor):
             try:
                 _, fp = get_mxq_quant_meta_data_file(model_id)
                 kwargs = {"weight_algo": weight_algo, "factor": factor}
-                configs, objective = find_optimal_configs(
-                    fp,
-                    bit_budget,
-                    time_limit=200,
-                    **kwargs,
+                start = time.perf_counter()
+                configs, _ = allocate(
+                    fp, bit_budget, allocator=allocator, time_limit=200, **kwargs
                 )
+                secs = time.perf_counter() - start
+                if report_gap and allocator != "milp":
+                    gap = allocation_gap(
+                        fp, bit_budget, configs, time_limit=200, **kwargs
+                    )
+                    print(
+                        f"{short_id} {bit_budget:.2f}: {allocator} fnorm "
+                        f"{gap['fnorm']:.4f} vs milp {gap['milp_fnorm']:.4f}, "
+                        f"gap {gap['gap']:.2%} in {secs * 1000:.1f} ms"
+                    )
                 for k, v in configs.items():
                     comps = k.split(".", 1)
                     layer, module = comps[0], comps[1]
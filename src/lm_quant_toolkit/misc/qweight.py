@@ -10,6 +10,7 @@ from safetensors.torch import save_file as safe_save
 from scipy.stats import kurtosis
 from torch import uint8
 
+from lm_quant_toolkit.adapter.snapshot import load_snapshot
 from lm_quant_toolkit.eval.common import calc_bits
 from lm_quant_toolkit.utils.safetensors import get_tensor, get_tensor_dual
 
@@ -145,8 +146,7 @@ def is_linear_module(key):
 
 
 def extract_quant_config(base_dir, model_id, config, algo="hqq"):
-    file_path = f"{base_dir}/{model_id}-{config}-{algo}/qmodel.pt"
-    dikt = torch.load(file_path, map_location="cpu")
+    dikt = load_snapshot(f"{base_dir}/{model_id}-{config}-{algo}")
     quant_configs = {}
     mem_fp16_all_total = 0
     mem_all_total = 0
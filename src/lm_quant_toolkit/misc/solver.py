@@ -0,0 +1,98 @@
+import functools
+import json
+import os
+import time
+
+import pandas as pd
+from hqq.utils.optimizer import find_optimal_configs
+
+from lm_quant_toolkit.utils.cache import (
+    atomic_path,
+    cache_key,
+    file_digest,
+    get_cache_dir,
+)
+
+# solves stopping this close to the time limit may have been cut short
+TIME_LIMIT_MARGIN = 0.95
+# bumped when the meaning of cached entries changes
+SOLVER_CACHE_VERSION = 3
+
+
+@functools.lru_cache(maxsize=64)
+def _metrics_digest(fp, mtime_ns, size):
+    return file_digest(fp)
+
+
+def get_metrics_digest(fp):
+    """Content hash of a quant metrics file, memoized by path and mtime."""
+    st = os.stat(fp)
+    return _metrics_digest(os.path.abspath(fp), st.st_mtime_ns, st.st_size)
+
+
+def get_min_bpp(fp):
+    """Smallest bits per parameter any allocation of metrics file `fp` needs."""
+    df = pd.read_csv(fp)
+    modules = df.groupby(["layer", "module"])
+    total_params = modules["params"].first().sum()
+    return modules["memmb"].min().sum() * 8 * 1024**2 / total_params
+
+
+def get_solver_cache_fp(fp, budget, time_limit=200, cache_dir=None, **kwargs):
+    key = cache_key(
+        get_metrics_digest(fp),
+        round(budget, 6),
+        time_limit,
+        kwargs,
+        SOLVER_CACHE_VERSION,
+    )
+    return os.path.join(get_cache_dir("solver", cache_dir), f"{key}.json")
+
+
+def solve_mxq(fp, budget, time_limit=200, cache_dir=None, **kwargs):
+    """`find_optimal_configs` backed by a persistent, content-addressed cache.
+
+    Results are keyed by the hash of the metrics file, the budget, the time
+    limit and the solver kwargs (weight_algo, factor, ...). Only proven
+    outcomes are cached: solutions found well within `time_limit` and
+    budgets below the smallest achievable bpp, which raise the same
+    ValueError on every call. Failures and solutions that may be cut short
+    by the time limit are solved again next time. Returns (configs,
+    objective) like `find_optimal_configs`.
+    """
+    cache_fp = get_solver_cache_fp(fp, budget, time_limit, cache_dir, **kwargs)
+    if os.path.exists(cache_fp):
+        with open(cache_fp, "r") as fh:
+            entry = json.load(fh)
+        if entry["status"] == "infeasible":
+            raise ValueError(entry["error"])
+        configs = {k: tuple(v) for k, v in entry["configs"].items()}
+        return configs, entry["objective"]
+
+    start = time.perf_counter()
+    try:
+        configs, objective = find_optimal_configs(
+            fp, budget, time_limit=time_limit, **kwargs
+        )
+    except ValueError as e:
+        # the solver doesn't tell a time out from infeasibility
+        if budget < get_min_bpp(fp) - 1e-9:
+            _save_entry(cache_fp, {"status": "infeasible", "error": str(e)})
+        raise
+    if time_limit and time.perf_counter() - start >= time_limit * TIME_LIMIT_MARGIN:
+        print(f"Warning: MILP at {budget:.2f} hit the time limit, not cached")
+        return configs, objective
+    _save_entry(
+        cache_fp,
+        {
+            "status": "optimal",
+            "objective": float(objective),
+            "configs": {k: [int(x) for x in v] for k, v in configs.items()},
+        },
+    )
+    return configs, objective
+
+
+def _save_entry(cache_fp, entry):
+    with atomic_path(cache_fp) as tmp, open(tmp, "w") as fh:
+        json.dump(entry, fh)
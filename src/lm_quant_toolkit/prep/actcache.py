@@ -0,0 +1,107 @@
+import json
+import os
+
+from lm_quant_toolkit.utils.cache import (
+    cache_key,
+    evict_lru,
+    get_cache_dir,
+    load_tensor,
+    save_tensor,
+    touch,
+)
+
+# linear inputs consumed by get_layers_for_scaling, q/k/v and gate/up share
+# their input so only one of each group is stored
+CACHED_FEATURES = [
+    "self_attn.q_proj",
+    "self_attn.o_proj",
+    "mlp.gate_proj",
+    "mlp.down_proj",
+]
+# number of entries that fit under the default size limit
+DEFAULT_ENTRIES = 2
+
+
+def estimate_entry_bytes(config, n_samples, seqlen, dtype_bytes=2):
+    """Estimate the size of one cache entry from the model config.
+
+    Three of the cached inputs and the layer output are `hidden_size` wide,
+    the down_proj input is `intermediate_size` wide. A Llama-7B entry with
+    128 samples of 512 tokens in fp16 is about 107 GiB.
+    """
+    width = 4 * config.hidden_size + config.intermediate_size
+    return n_samples * seqlen * width * dtype_bytes * config.num_hidden_layers
+
+
+class ActivationCache:
+    """Disk-backed cache of calibration activations of each decoder layer.
+
+    Entries are keyed by (model, calibration dataset, n_samples, seqlen).
+    For every layer the inputs of the linear modules and the layer output
+    (the next layer's input) are stored as .npy files and memory-mapped on
+    load. Whole entries are evicted in LRU order to stay under `max_bytes`,
+    which defaults to `DEFAULT_ENTRIES` times `entry_bytes` when the entry
+    size is known. An entry larger than `max_bytes` is evicted as soon as
+    another entry is written, so a warning is printed in that case.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        calib_data,
+        n_samples,
+        seqlen,
+        cache_dir=None,
+        max_bytes=None,
+        entry_bytes=None,
+    ):
+        self.root = get_cache_dir("activations", cache_dir)
+        if max_bytes is None:
+            if entry_bytes is None:
+                raise ValueError("Either max_bytes or entry_bytes is required")
+            max_bytes = DEFAULT_ENTRIES * entry_bytes
+        elif entry_bytes is not None and entry_bytes > max_bytes:
+            print(
+                f"Warning: activation cache entry of {model_name} needs about "
+                f"{entry_bytes / 1024**3:.1f} GiB, more than the "
+                f"{max_bytes / 1024**3:.1f} GiB limit, it will not be reused"
+            )
+        self.max_bytes = max_bytes
+        key = cache_key(model_name, calib_data, n_samples, seqlen)
+        self.entry_dir = os.path.join(self.root, key)
+        os.makedirs(self.entry_dir, exist_ok=True)
+        touch(self.entry_dir)
+
+    def has_layer(self, layer):
+        return os.path.exists(self._meta_fp(layer))
+
+    def load_layer(self, layer):
+        with open(self._meta_fp(layer), "r") as fh:
+            dtypes = json.load(fh)
+        layer_dir = self._layer_dir(layer)
+        input_feat = {
+            name: load_tensor(os.path.join(layer_dir, f"{name}.npy"), dtypes[name])
+            for name in CACHED_FEATURES
+        }
+        outputs = load_tensor(os.path.join(layer_dir, "outputs.npy"), dtypes["outputs"])
+        touch(self.entry_dir)
+        return input_feat, outputs
+
+    def save_layer(self, layer, input_feat, outputs):
+        layer_dir = self._layer_dir(layer)
+        os.makedirs(layer_dir, exist_ok=True)
+        dtypes = {
+            name: save_tensor(os.path.join(layer_dir, f"{name}.npy"), input_feat[name])
+            for name in CACHED_FEATURES
+        }
+        dtypes["outputs"] = save_tensor(os.path.join(layer_dir, "outputs.npy"), outputs)
+        # the meta file marks the layer as complete, so it is written last
+        with open(self._meta_fp(layer), "w") as fh:
+            json.dump(dtypes, fh)
+        evict_lru(self.root, self.max_bytes, keep=(self.entry_dir,))
+
+    def _layer_dir(self, layer):
+        return os.path.join(self.entry_dir, f"layer-{layer}")
+
+    def _meta_fp(self, layer):
+        return os.path.join(self._layer_dir(layer), "meta.json")
@@ -1,16 +1,37 @@
+import multiprocessing
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from timeit import default_timer as timer
 
 import pandas as pd
 import torch
 from hqq.core.quantize import Quantizer as hQuant
 
+from lm_quant_toolkit.utils.cache import atomic_path
 from lm_quant_toolkit.utils.hub import (
     LLAMA_MODELS,
     VIT_OPENCLIP_MODELS,
     get_hf_model_storge_base_dir,
 )
-from lm_quant_toolkit.utils.safetensors import get_tensor
+from lm_quant_toolkit.utils.safetensors import get_reader, get_tensor
+
+FNORM_COLUMNS = [
+    "layer",
+    "module",
+    "nbit1",
+    "gsize1",
+    "nbit2",
+    "gsize2",
+    "fnorm",
+    "memmb",
+    "params",
+]
+
+NBITS1 = [2, 3, 4, 8]
+GSIZES1 = [32, 64, 128]
+NBITS2 = [8]
+GSIZES2 = [128]
 
 
 def quant_hqq(tensor, nbits, group_size=64, optimize=True):
@@ -20,6 +41,44 @@ def quant_hqq(tensor, nbits, group_size=64, optimize=True):
     return hQuant.dequantize(wq, meta)
 
 
+def sweep_fnorm(w, nbits1, gsizes1, nbits2, gsizes2):
+    """Compute FNorm and memory footprint for the whole config grid of `w`.
+
+    The dequantized weight only depends on (nbit1, gsize1), so HQQ runs once
+    per distinct first-level config. The second-level (nbit2, gsize2) rows
+    share that FNorm and only differ in memory, which is derived analytically.
+    """
+    params = w.numel()
+    norms = {}
+    rows = []
+    for nbit1 in nbits1:
+        for gsize1 in gsizes1:
+            if (nbit1, gsize1) not in norms:
+                wq_hqq = quant_hqq(w, nbits=nbit1, group_size=gsize1, optimize=True)
+                norms[(nbit1, gsize1)] = torch.norm(w - wq_hqq).item()
+                del wq_hqq
+            norm_hqq = norms[(nbit1, gsize1)]
+            rows.extend(
+                {
+                    "nbit1": nbit1,
+                    "gsize1": gsize1,
+                    "nbit2": nbit2,
+                    "gsize2": gsize2,
+                    "fnorm": norm_hqq,
+                    "memmb": calc_memmb(nbit1, gsize1, nbit2, gsize2, params),
+                    "params": params,
+                }
+                for nbit2 in nbits2
+                for gsize2 in gsizes2
+            )
+    return rows
+
+
+def calc_memmb(nbit1, gsize1, nbit2, gsize2, params):
+    bpp = nbit1 + 2 * nbit2 / gsize1 + 32 / (gsize1 * gsize2)
+    return bpp * params / 8 / (1024**2)
+
+
 def calc_fnorm_vit(
     state_dict,
     model_type,
@@ -32,71 +91,30 @@ def calc_fnorm_vit(
     nbits2,
     gsizes2,
 ):
-    dikts = []
     matrix_name = f"{prefix}.{layer}.{module}.{suffix}"
     w = state_dict[matrix_name]
-    params = w.numel()
-    for nbit1 in nbits1:
-        for gsize1 in gsizes1:
-            for nbit2 in nbits2:
-                for gsize2 in gsizes2:
-                    wq_hqq = quant_hqq(w, nbits=nbit1, group_size=gsize1, optimize=True)
-                    norm_hqq = torch.norm(w - wq_hqq).item()
-                    bpp = nbit1 + 2 * nbit2 / gsize1 + 32 / (gsize1 * gsize2)
-                    memmb = bpp * params / 8 / (1024**2)
-                    dikt = {
-                        "layer": layer,
-                        "module": f"{model_type}.{module}",
-                        "nbit1": nbit1,
-                        "gsize1": gsize1,
-                        "nbit2": nbit2,
-                        "gsize2": gsize2,
-                        "fnorm": norm_hqq,
-                        "memmb": memmb,
-                        "params": params,
-                    }
-                    dikts.append(dikt)
-    return dikts
+    return [
+        {"layer": layer, "module": f"{model_type}.{module}", **row}
+        for row in sweep_fnorm(w, nbits1, gsizes1, nbits2, gsizes2)
+    ]
 
 
 def calc_fnorm(
     base_dir, prefix, layer, module, suffix, nbits1, gsizes1, nbits2, gsizes2
 ):
-    dikts = []
     matrix_name = f"{prefix}.{layer}.{module}.{suffix}"
     w = get_tensor(matrix_name, base_dir)
-    params = w.numel()
-    for nbit1 in nbits1:
-        for gsize1 in gsizes1:
-            for nbit2 in nbits2:
-                for gsize2 in gsizes2:
-                    wq_hqq = quant_hqq(w, nbits=nbit1, group_size=gsize1, optimize=True)
-                    norm_hqq = torch.norm(w - wq_hqq).item()
-                    bpp = nbit1 + 2 * nbit2 / gsize1 + 32 / (gsize1 * gsize2)
-                    memmb = bpp * params / 8 / (1024**2)
-                    dikt = {
-                        "layer": layer,
-                        "module": module,
-                        "nbit1": nbit1,
-                        "gsize1": gsize1,
-                        "nbit2": nbit2,
-                        "gsize2": gsize2,
-                        "fnorm": norm_hqq,
-                        "memmb": memmb,
-                        "params": params,
-                    }
-                    dikts.append(dikt)
-    return dikts
+    return [
+        {"layer": layer, "module": module, **row}
+        for row in sweep_fnorm(w, nbits1, gsizes1, nbits2, gsizes2)
+    ]
 
 
 def calc_fnorm_for_vit_model(model_id, base_dir, layer_cfg):
     # self_attns = ["out_proj"]
     self_attns = []
     mlps = ["c_fc", "c_proj"]
-    nbits1 = [2, 3, 4, 8]
-    gsizes1 = [32, 64, 128]
-    nbits2 = [8]
-    gsizes2 = [128]
+    nbits1, gsizes1, nbits2, gsizes2 = NBITS1, GSIZES1, NBITS2, GSIZES2
     prefixes = [
         "visual.transformer.resblocks",
         "transformer.resblocks",
@@ -147,76 +165,99 @@ def calc_fnorm_for_vit_model(model_id, base_dir, layer_cfg):
     file_name = f"data/fnorm-{model_id.split('/')[1]}.csv"
     df.to_csv(
         file_name,
-        columns=[
-            "layer",
-            "module",
-            "nbit1",
-            "gsize1",
-            "nbit2",
-            "gsize2",
-            "fnorm",
-            "memmb",
-            "params",
-        ],
+        columns=FNORM_COLUMNS,
         index=False,
     )
 
 
-def calc_fnorm_for_model(model_id, base_dir, layers, output_dir="data"):
+def get_fnorm_units(layers):
     self_attns = ["q_proj", "v_proj", "k_proj", "o_proj"]
     mlps = ["gate_proj", "up_proj", "down_proj"]
-    nbits1 = [2, 3, 4, 8]
-    gsizes1 = [32, 64, 128]
-    nbits2 = [8]
-    gsizes2 = [128]
+    units = []
+    for layer in range(layers):
+        units.extend((layer, f"self_attn.{attn}") for attn in self_attns)
+        units.extend((layer, f"mlp.{mlp}") for mlp in mlps)
+    return units
+
+
+def _get_fnorm_unit_fp(ckpt_dir, layer, module):
+    return os.path.join(ckpt_dir, f"{layer}-{module}.pkl")
+
+
+def _init_fnorm_worker(workers):
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+
+def _calc_fnorm_unit(base_dir, layer, module, ckpt_dir):
     prefix = "model.layers"
     suffix = "weight"
-    dikts = []
-    for layer in range(layers):
-        for attn in self_attns:
-            ds = calc_fnorm(
-                base_dir,
-                prefix,
-                layer,
-                f"self_attn.{attn}",
-                suffix,
-                nbits1,
-                gsizes1,
-                nbits2,
-                gsizes2,
-            )
-            dikts.extend(ds)
-        for mlp in mlps:
-            ds = calc_fnorm(
-                base_dir,
-                prefix,
-                layer,
-                f"mlp.{mlp}",
-                suffix,
-                nbits1,
-                gsizes1,
-                nbits2,
-                gsizes2,
-            )
-            dikts.extend(ds)
+    ds = calc_fnorm(
+        base_dir,
+        prefix,
+        layer,
+        module,
+        suffix,
+        NBITS1,
+        GSIZES1,
+        NBITS2,
+        GSIZES2,
+    )
+    # write to a unique temporary file so a crash never leaves a partial unit
+    fp = _get_fnorm_unit_fp(ckpt_dir, layer, module)
+    with atomic_path(fp) as tmp:
+        pd.DataFrame(ds).to_pickle(tmp)
+    return layer, module
 
-    df = pd.DataFrame(dikts)
-    file_name = f"{output_dir}/fnorm-{model_id.split('/')[1]}.csv"
+
+def calc_fnorm_for_model(model_id, base_dir, layers, output_dir="data", workers=1):
+    short_id = model_id.split("/")[1]
+    ckpt_dir = os.path.join(output_dir, f"fnorm-{short_id}.ckpt")
+    os.makedirs(ckpt_dir, exist_ok=True)
+    units = get_fnorm_units(layers)
+    todo = [
+        unit
+        for unit in units
+        if not os.path.exists(_get_fnorm_unit_fp(ckpt_dir, *unit))
+    ]
+    # visit the units in on-disk order so each shard is read sequentially
+    reader = get_reader(base_dir)
+    names = {
+        f"model.layers.{layer}.{module}.weight": (layer, module)
+        for layer, module in todo
+    }
+    todo = [names[name] for name in reader.order(names)]
+    print(f"Todo: {len(todo)}, Done: {len(units) - len(todo)}, Total: {len(units)}")
+
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_fnorm_worker,
+            initargs=(workers,),
+        ) as executor:
+            futures = [
+                executor.submit(_calc_fnorm_unit, base_dir, layer, module, ckpt_dir)
+                for layer, module in todo
+            ]
+            for future in as_completed(futures):
+                layer, module = future.result()
+                print(f"Finished layer {layer} {module}")
+    else:
+        for layer, module in todo:
+            _calc_fnorm_unit(base_dir, layer, module, ckpt_dir)
+
+    # assemble in the serial (layer, module) order regardless of completion order
+    df = pd.concat(
+        [pd.read_pickle(_get_fnorm_unit_fp(ckpt_dir, *unit)) for unit in units],
+        ignore_index=True,
+    )
+    file_name = f"{output_dir}/fnorm-{short_id}.csv"
     df.to_csv(
         file_name,
-        columns=[
-            "layer",
-            "module",
-            "nbit1",
-            "gsize1",
-            "nbit2",
-            "gsize2",
-            "fnorm",
-            "memmb",
-            "params",
-        ],
+        columns=FNORM_COLUMNS,
         index=False,
     )
+    shutil.rmtree(ckpt_dir)
 
 
 def main_vit():
@@ -241,6 +282,22 @@ def main():
         print(f"Finished {model_id} metrics calc in {t2 - t1} seconds")
 
 
+def join_fnorm_kurtosis(df_fnorm, df_wdist):
+    # calculate scaled kurtosis
+    df_kurt_agg = df_wdist.groupby("module").agg(
+        kurt_max=pd.NamedAgg(column="kurtosis", aggfunc="max"),
+        kurt_min=pd.NamedAgg(column="kurtosis", aggfunc="min"),
+    )
+    df_wdist = df_wdist.merge(df_kurt_agg, how="left", on="module")
+    df_wdist["kurtosis_scaled"] = (df_wdist["kurtosis"] - df_wdist["kurt_min"]) / (
+        df_wdist["kurt_max"] - df_wdist["kurt_min"]
+    )
+    df_wdist = df_wdist[["layer", "module", "kurtosis", "kurtosis_scaled"]]
+    df_fnorm = df_fnorm[FNORM_COLUMNS]
+    df_fnorm = pd.merge(df_fnorm, df_wdist, how="inner", on=["module", "layer"])
+    return df_fnorm[FNORM_COLUMNS + ["kurtosis", "kurtosis_scaled"]]
+
+
 def join_kurtosis():
     for model_id, model in LLAMA_MODELS.items():
         exp = model.get("experiment", False)
@@ -250,44 +307,7 @@ def join_kurtosis():
         model_short_id = model_id.split("/")[1]
         df_fnorm = pd.read_csv(f"data/fnorm-{model_short_id}.csv")
         df_wdist = pd.read_csv(f"data/wdist-{model_short_id}.csv")
-        # calculate scaled kurtosis
-        df_kurt_agg = df_wdist.groupby("module").agg(
-            kurt_max=pd.NamedAgg(column="kurtosis", aggfunc="max"),
-            kurt_min=pd.NamedAgg(column="kurtosis", aggfunc="min"),
-        )
-        df_wdist = df_wdist.merge(df_kurt_agg, how="left", on="module")
-        df_wdist["kurtosis_scaled"] = (df_wdist["kurtosis"] - df_wdist["kurt_min"]) / (
-            df_wdist["kurt_max"] - df_wdist["kurt_min"]
-        )
-        df_fnorm = df_fnorm[
-            [
-                "layer",
-                "module",
-                "nbit1",
-                "gsize1",
-                "nbit2",
-                "gsize2",
-                "fnorm",
-                "memmb",
-                "params",
-            ]
-        ]
-        df_fnorm = pd.merge(df_fnorm, df_wdist, how="inner", on=["module", "layer"])
-        df_fnorm = df_fnorm[
-            [
-                "layer",
-                "module",
-                "nbit1",
-                "gsize1",
-                "nbit2",
-                "gsize2",
-                "fnorm",
-                "memmb",
-                "params",
-                "kurtosis",
-                "kurtosis_scaled",
-            ]
-        ]
+        df_fnorm = join_fnorm_kurtosis(df_fnorm, df_wdist)
 
         df_fnorm.to_csv(f"fnorm-{model_short_id}.csv", index=False)
         t2 = timer()
@@ -1,3 +1,4 @@
+import contextlib
 import functools
 import gc
 import inspect
@@ -12,12 +13,14 @@ import torch
 import torch.nn as nn
 from bitsandbytes.functional import dequantize_nf4
 from bitsandbytes.nn import Params4bit
-from datasets import load_dataset
 from hqq.core.quantize import Quantizer as hQuant
 from tqdm import tqdm
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer
 
+from lm_quant_toolkit.prep.actcache import ActivationCache, estimate_entry_bytes
+from lm_quant_toolkit.utils.calib import get_calib_blocks
+
 
 # nbits is defined as placeholder to be consistent with other quant methods
 def quant_nf4(tensor, nbits=4, group_size=64):
@@ -32,6 +35,26 @@ def quant_hqq(tensor, nbits, group_size=64, optimize=True):
     return hQuant.dequantize(wq, meta)
 
 
+QUANT_FUNCS = {
+    "rtn": functools.partial(quant_hqq, optimize=False),
+    "hqq": functools.partial(quant_hqq, optimize=True),
+    "bnb": quant_nf4,
+}
+
+
+@contextlib.contextmanager
+def swap_weights(layers, weights):
+    """Temporarily replace the weights of `layers`, restoring them on exit."""
+    orig_weights = [fc.weight.data for fc in layers]
+    try:
+        for fc, w in zip(layers, weights):
+            fc.weight.data = w
+        yield
+    finally:
+        for fc, w in zip(layers, orig_weights):
+            fc.weight.data = w
+
+
 def get_named_linears(module):
     return {name: m for name, m in module.named_modules() if isinstance(m, nn.Linear)}
 
@@ -120,48 +143,17 @@ def get_calib_dataset(
     split="train",
     text_column="text",
 ):
-    if data == "pileval":
-        dataset = load_dataset("mit-han-lab/pile-val-backup", split="validation")
-    elif data == "wikitext":
-        dataset = load_dataset("wikitext", "wikitext-2-raw-v1", split="validation")
-    elif data == "bos":
-        dataset = load_dataset("schnell18/branch-of-science", split="train")
-    elif data == "c4":
-        dataset = load_dataset(
-            "allenai/c4",
-            data_files={"validation": "en/c4-validation.00000-of-00008.json.gz"},
-            split="validation",
-            download_mode="reuse_dataset_if_exists",
-        )
-    else:
-        dataset = load_dataset(data, split=split)
-
-    dataset = dataset.shuffle(seed=42)
-
-    samples = []
-    n_run = 0
-    for data in dataset:
-        if isinstance(data, list):
-            line_encoded = data
-        else:
-            line = data[text_column]
-            line = line.strip()
-            line_encoded = tokenizer.encode(line)
-        if len(line_encoded) > 512:
-            continue
-        sample = torch.tensor([line_encoded])
-        if sample.numel() == 0:
-            continue
-        samples.append(sample)
-        n_run += 1
-        if n_run == n_samples:
-            break
-    # now concatenate all samples and split according to block size
-    cat_samples = torch.cat(samples, dim=1)
-    n_split = cat_samples.shape[1] // block_size
-    return [
-        cat_samples[:, i * block_size : (i + 1) * block_size] for i in range(n_split)
-    ]
+    blocks = get_calib_blocks(
+        tokenizer,
+        data=data,
+        split=split,
+        n_samples=n_samples,
+        block_size=block_size,
+        seed=42,
+        sampling="contiguous",
+        text_column=text_column,
+    )
+    return [block.long().unsqueeze(0) for block in blocks]
 
 
 class SensitiveLayerFinder:
@@ -169,35 +161,33 @@ class SensitiveLayerFinder:
         self,
         model,
         model_name,
-        w_bit,
-        group_size,
+        configs,
         tokenizer,
         calib_data="pileval",
         split="train",
         text_column="text",
-        quant_method="hqq",
+        quant_methods=("hqq",),
+        activation_cache=None,
     ) -> None:
         self.model = model
         self.model_name = model_name
         self.tokenizer = tokenizer
-        self.w_bit = w_bit
-        self.group_size = group_size
+        # list of (w_bit, group_size) evaluated against the same layer inputs
+        self.configs = configs
         self.calib_data = calib_data
         self.split = split
         self.text_column = text_column
-        self.quant_method = quant_method
+        if isinstance(quant_methods, str):
+            quant_methods = [quant_methods]
+        self.quant_methods = quant_methods
+        # optional ActivationCache, saves the layer forward passes on reruns
+        self.activation_cache = activation_cache
         self.layers, self.module_kwargs, self.inps = self.init_quant()
-        if self.quant_method == "rtn":
-            self.quant_func = functools.partial(quant_hqq, optimize=False)
-        elif self.quant_method == "hqq":
-            self.quant_func = functools.partial(quant_hqq, optimize=True)
-        elif self.quant_method == "bnb":
-            self.quant_func = quant_nf4
 
     @torch.no_grad()
     def measure(self, csv_fp):
         dikts = []
-        cfg = f"b{self.w_bit}g{self.group_size}"
+        cfg = "-".join([f"b{w_bit}g{group_size}" for w_bit, group_size in self.configs])
         for i in tqdm(
             range(len(self.layers)), desc=f"{self.model_name}-{cfg}-{self.calib_data}"
         ):
@@ -218,9 +208,15 @@ class SensitiveLayerFinder:
                     "attention_mask"
                 ].to(common_device)
 
-            self.inps = self.inps.to(common_device)
-            named_linears = get_named_linears(self.layers[i])
-            input_feat = self._get_input_feat(self.layers[i], named_linears)
+            cache = self.activation_cache
+            if cache is not None and cache.has_layer(i):
+                input_feat, self.inps = cache.load_layer(i)
+            else:
+                self.inps = self.inps.to(common_device)
+                named_linears = get_named_linears(self.layers[i])
+                input_feat = self._get_input_feat(self.layers[i], named_linears)
+                if cache is not None:
+                    cache.save_layer(i, input_feat, self.inps)
             clear_memory()
 
             module_config = get_layers_for_scaling(
@@ -229,18 +225,20 @@ class SensitiveLayerFinder:
 
             for layer in module_config:
                 part = layer.pop("part", "Unknown")
-                mse = self._measure_layer_sensitivity(self.layers[i], **layer)
-                dikts.append(
-                    {
-                        "dataset": self.calib_data,
-                        "part": part,
-                        "model": self.model_name,
-                        "nbits": self.w_bit,
-                        "group_size": self.group_size,
-                        "layer": i,
-                        "sensitivity": mse,
-                    }
-                )
+                mses = self._measure_layer_sensitivity(self.layers[i], **layer)
+                for (quant_method, w_bit, group_size), mse in mses.items():
+                    dikts.append(
+                        {
+                            "dataset": self.calib_data,
+                            "quant_method": quant_method,
+                            "part": part,
+                            "model": self.model_name,
+                            "nbits": w_bit,
+                            "group_size": group_size,
+                            "layer": i,
+                            "sensitivity": mse,
+                        }
+                    )
 
             del module_config
             del input_feat
@@ -265,28 +263,37 @@ class SensitiveLayerFinder:
 
         module_kwargs = self._sanitize_kwargs(kwargs, module2inspect)
 
+        # the fp16 reference output is shared by all configs
         fp16_output = module2inspect(inp, **module_kwargs)
         if isinstance(fp16_output, tuple):
             fp16_output = fp16_output[0]
 
-        # Quantize the weights
-        for fc in layers:
-            # call quantization function
-            fc.weight.data = self.quant_func(
-                fc.weight.data, self.w_bit, self.group_size
-            )
-
-        # W * X
-        int_w_output = module2inspect(inp, **module_kwargs)
-        if isinstance(int_w_output, tuple):
-            int_w_output = int_w_output[0]
-
-        # compute mean squared error (L2 norm)
-        mse = (fp16_output - int_w_output).float().pow(2).mean().item()
+        mses = {}
+        for quant_method in self.quant_methods:
+            quant_func = QUANT_FUNCS[quant_method]
+            for w_bit, group_size in self.configs:
+                # Quantize the weights out of place, the module keeps its
+                # original weights once the measurement is done
+                qweights = [
+                    quant_func(fc.weight.data, w_bit, group_size) for fc in layers
+                ]
+
+                # W * X
+                with swap_weights(layers, qweights):
+                    int_w_output = module2inspect(inp, **module_kwargs)
+                if isinstance(int_w_output, tuple):
+                    int_w_output = int_w_output[0]
+
+                # compute mean squared error (L2 norm)
+                mses[(quant_method, w_bit, group_size)] = (
+                    (fp16_output - int_w_output).float().pow(2).mean().item()
+                )
+                del qweights
+                del int_w_output
+                clear_memory()
         del fp16_output
-        del int_w_output
         clear_memory()
-        return mse
+        return mses
 
     def init_quant(self, n_samples=128, seqlen=512):
         modules = self.model.model.layers
@@ -409,7 +416,26 @@ class SensitiveLayerFinder:
         return sanitized_kwargs
 
 
-def measure_sensitivity(models, quant_method, cfgs, calib_datasets, csv_fp):
+def measure_sensitivity(
+    models,
+    quant_methods,
+    cfgs,
+    calib_datasets,
+    csv_fp,
+    activation_cache_dir=None,
+    activation_cache_gb=None,
+):
+    """Measure the sensitivity of every model/dataset/config combination.
+
+    Activations are cached on disk when `activation_cache_dir` or
+    `activation_cache_gb` is given, so reruns skip the layer forward passes.
+    Without `activation_cache_gb` the cache is sized to hold two entries of
+    the model being measured.
+    """
+    use_cache = activation_cache_dir is not None or activation_cache_gb is not None
+    max_bytes = None
+    if activation_cache_gb is not None:
+        max_bytes = int(activation_cache_gb * 1024**3)
     pat = re.compile(r"b(\d)g(\d+)")
     bgs = []
     for cfg in cfgs:
@@ -417,30 +443,44 @@ def measure_sensitivity(models, quant_method, cfgs, calib_datasets, csv_fp):
         if m:
             bgs.append((int(m.group(1)), int(m.group(2))))
     dikts = []
-    for ds in calib_datasets:
-        for bg in bgs:
-            for model_path in models:
-                short_name = model_path.split("/")[1]
-                model = AutoModelForCausalLM.from_pretrained(
+    for model_path in models:
+        # load the model once, all configs are measured in the same sweep
+        short_name = model_path.split("/")[1]
+        model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            offload_state_dict=False,
+            max_memory={0: "18GiB", "cpu": "60GiB"},
+        )
+        tokenizer = AutoTokenizer.from_pretrained(model_path, legacy=False)
+        for ds in calib_datasets:
+            cache = None
+            if use_cache:
+                cache = ActivationCache(
                     model_path,
-                    torch_dtype=torch.float16,
-                    device_map="auto",
-                    offload_state_dict=False,
-                    max_memory={0: "18GiB", "cpu": "60GiB"},
-                )
-                tokenizer = AutoTokenizer.from_pretrained(model_path, legacy=False)
-                finder = SensitiveLayerFinder(
-                    model,
-                    short_name,
-                    bg[0],
-                    bg[1],
-                    tokenizer,
-                    ds,
-                    quant_method=quant_method,
+                    (ds, "train", "text"),
+                    n_samples=128,
+                    seqlen=512,
+                    cache_dir=activation_cache_dir,
+                    max_bytes=max_bytes,
+                    entry_bytes=estimate_entry_bytes(model.config, 128, 512),
                 )
-                dikts.extend(finder.measure(csv_fp))
-                clear_memory()
-                time.sleep(2)
+            finder = SensitiveLayerFinder(
+                model,
+                short_name,
+                bgs,
+                tokenizer,
+                ds,
+                quant_methods=quant_methods,
+                activation_cache=cache,
+            )
+            dikts.extend(finder.measure(csv_fp))
+            del finder
+            clear_memory()
+        del model
+        clear_memory()
+        time.sleep(2)
 
     df = pd.DataFrame(dikts)
     df.to_csv(csv_fp, index=False)
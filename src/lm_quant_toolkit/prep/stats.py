@@ -0,0 +1,124 @@
+import abc
+
+import pandas as pd
+
+from lm_quant_toolkit.prep.fnorm import (
+    GSIZES1,
+    GSIZES2,
+    NBITS1,
+    NBITS2,
+    get_fnorm_units,
+    join_fnorm_kurtosis,
+    sweep_fnorm,
+)
+from lm_quant_toolkit.prep.wdist import get_llama_quantable_params
+from lm_quant_toolkit.utils.safetensors import get_reader
+from lm_quant_toolkit.utils.stats import summarize_tensor
+
+
+class MetricProducer(abc.ABC):
+    """One metric table of the stats pipeline."""
+
+    # whether `consume` is fed every weight the pipeline reads
+    needs_tensor = False
+
+    @abc.abstractmethod
+    def to_frame(self, units, reader, layers, llama2):
+        pass
+
+
+class TensorMetricProducer(MetricProducer):
+    """Collect per-(layer, module) rows from weights read by the stats pipeline."""
+
+    needs_tensor = True
+
+    def __init__(self):
+        self.rows = {}
+
+    def consume(self, layer, module, w):
+        self.rows[(layer, module)] = self.calc(layer, module, w)
+
+    @abc.abstractmethod
+    def calc(self, layer, module, w):
+        pass
+
+    def to_frame(self, units, reader, layers, llama2):
+        # emit rows in the canonical (layer, module) order
+        return pd.DataFrame([row for unit in units for row in self.rows[unit]])
+
+
+class FNormProducer(TensorMetricProducer):
+    def calc(self, layer, module, w):
+        return [
+            {"layer": layer, "module": module, **row}
+            for row in sweep_fnorm(w, NBITS1, GSIZES1, NBITS2, GSIZES2)
+        ]
+
+
+class WDistProducer(TensorMetricProducer):
+    def calc(self, layer, module, w):
+        stats = summarize_tensor(w)
+        return [
+            {
+                "module": module,
+                "layer": layer,
+                "param_count": w.numel(),
+                "mean": stats.mean,
+                "variance": stats.variance,
+                "skewness": stats.skewness,
+                "kurtosis": stats.kurtosis,
+                "percentile_0": stats.abs_percentile(0),
+                "percentile_99": stats.abs_percentile(99),
+                "percentile_999": stats.abs_percentile(99.9),
+                "percentile_9999": stats.abs_percentile(99.99),
+                "percentile_100": stats.abs_percentile(100),
+            }
+        ]
+
+
+class QuantableProducer(MetricProducer):
+    # parameter counts come from the shard headers, no tensor is needed
+    def to_frame(self, units, reader, layers, llama2):
+        return pd.DataFrame(get_llama_quantable_params(reader, layers, llama2=llama2))
+
+
+METRIC_PRODUCERS = {
+    "fnorm": FNormProducer,
+    "wdist": WDistProducer,
+    "quantable": QuantableProducer,
+}
+
+
+def calc_stats_for_model(
+    model_id, base_dir, layers, output_dir="data", metrics=None, llama2=True
+):
+    """Read every quantizable weight once and feed it to all metric producers.
+
+    Writes `{metric}-{model}.csv` for each requested metric. When both FNorm
+    and weight distribution are computed, the FNorm table is emitted already
+    joined with `kurtosis` and `kurtosis_scaled`.
+    """
+    metrics = list(METRIC_PRODUCERS) if metrics is None else metrics
+    producers = {metric: METRIC_PRODUCERS[metric]() for metric in metrics}
+    reader = get_reader(base_dir)
+    units = get_fnorm_units(layers)
+    names = {
+        f"model.layers.{layer}.{module}.weight": (layer, module)
+        for layer, module in units
+    }
+    consumers = [p for p in producers.values() if p.needs_tensor]
+    if consumers:
+        for full_name, w in reader.iter_tensors(names):
+            layer, module = names[full_name]
+            for producer in consumers:
+                producer.consume(layer, module, w)
+
+    frames = {
+        metric: producer.to_frame(units, reader, layers, llama2)
+        for metric, producer in producers.items()
+    }
+    if "fnorm" in frames and "wdist" in frames:
+        frames["fnorm"] = join_fnorm_kurtosis(frames["fnorm"], frames["wdist"])
+    short_id = model_id.split("/")[1]
+    for metric, df in frames.items():
+        df.to_csv(f"{output_dir}/{metric}-{short_id}.csv", index=False)
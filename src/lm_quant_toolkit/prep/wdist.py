@@ -1,8 +1,7 @@
+import math
 import re
 
-import numpy as np
 import pandas as pd
-from scipy.stats import kurtosis
 
 from lm_quant_toolkit.utils.hub import (
     LLAMA_MODELS,
@@ -10,7 +9,8 @@ from lm_quant_toolkit.utils.hub import (
     get_hf_model_storge_base_dir,
 )
 from lm_quant_toolkit.utils.pickle import load_state_dict
-from lm_quant_toolkit.utils.safetensors import get_tensor
+from lm_quant_toolkit.utils.safetensors import get_reader
+from lm_quant_toolkit.utils.stats import summarize_tensor
 
 
 def calculate_kurtosis_llm(model_id, base_dir, layers, output_dir):
@@ -23,23 +23,24 @@ def calculate_kurtosis_llm(model_id, base_dir, layers, output_dir):
         "mlp.down_proj",
         "mlp.up_proj",
     ]
+    names = {
+        f"model.layers.{layer}.{module}.weight": (module, layer)
+        for module in modules
+        for layer in range(layers)
+    }
+    kurts = {}
+    for full_name, w in get_reader(base_dir).iter_tensors(names):
+        kurts[full_name] = (w.numel(), summarize_tensor(w).kurtosis)
     dikts = []
-    for module in modules:
-        for layer in range(layers):
-            full_name = f"model.layers.{layer}.{module}.weight"
-            w = get_tensor(full_name, base_dir)
-            param_count = w.numel()
-            w = w.flatten().float().numpy()
-            kurt_pearson = kurtosis(
-                w, axis=None, fisher=False, bias=True, nan_policy="omit"
-            )
-            dikt = {
-                "module": module,
-                "layer": layer,
-                "param_count": param_count,
-                "kurtosis": kurt_pearson,
-            }
-            dikts.append(dikt)
+    for full_name, (module, layer) in names.items():
+        param_count, kurt_pearson = kurts[full_name]
+        dikt = {
+            "module": module,
+            "layer": layer,
+            "param_count": param_count,
+            "kurtosis": kurt_pearson,
+        }
+        dikts.append(dikt)
     df = pd.DataFrame(dikts)
     short_id = model_id.split("/")[1]
     csv_fp = f"{output_dir}/kurtosis-{short_id}.csv"
@@ -64,10 +65,7 @@ def calculate_kurtosis_vit(model_id, model_cfg, output_dir):
             for layer in range(layers):
                 full_name = f"{prefix}.resblocks.{layer}.{module}.weight"
                 w = state_dict[full_name]
-                w = w.flatten().float().numpy()
-                kurt_pearson = kurtosis(
-                    w, axis=None, fisher=False, bias=True, nan_policy="omit"
-                )
+                kurt_pearson = summarize_tensor(w).kurtosis
                 dikt = {
                     "module": f"{model_type}.{module}",
                     "layer": layer,
@@ -114,11 +112,11 @@ def summarize_vit_percentiles(
                 full_name = f"{prefix}.resblocks.{layer}.{module}"
                 w = state_dict[full_name]
                 param_count = w.numel()
-                w = w.flatten().float().numpy()
-                percentiles = np.percentile(np.abs(w), [0, 99, 99.9, 99.99, 100])
-                kurt_pearson = kurtosis(
-                    w, axis=None, fisher=False, bias=True, nan_policy="omit"
-                )
+                stats = summarize_tensor(w)
+                percentiles = [
+                    stats.abs_percentile(q) for q in [0, 99, 99.9, 99.99, 100]
+                ]
+                kurt_pearson = stats.kurtosis
                 dikt = {
                     "type": model_type,
                     "module": module,
@@ -136,7 +134,7 @@ def summarize_vit_percentiles(
     df.to_csv(csv_fp, index=False)
 
 
-def summarize_llama_quantable_params(base_dir, layers, fp, llama2=True):
+def get_llama_quantable_params(reader, layers, llama2=True):
     modules = {
         "norm": {"layerwise": False, "quant": False},
         "lm_head": {"layerwise": False, "quant": False, "prefix": ""},
@@ -163,8 +161,7 @@ def summarize_llama_quantable_params(base_dir, layers, fp, llama2=True):
         if data["layerwise"]:
             for layer in range(layers):
                 full_name = f"model.layers.{layer}.{module}.{suffix}"
-                w = get_tensor(full_name, base_dir)
-                param_count = w.numel()
+                param_count = math.prod(reader.get_shape(full_name))
                 dikt = {
                     "module": module,
                     "layer": layer,
@@ -178,8 +175,7 @@ def summarize_llama_quantable_params(base_dir, layers, fp, llama2=True):
                 full_name = f"{module}.{suffix}"
             else:
                 full_name = f"{prefix}.{module}.{suffix}"
-            w = get_tensor(full_name, base_dir)
-            param_count = w.numel()
+            param_count = math.prod(reader.get_shape(full_name))
             dikt = {
                 "module": module,
                 "layer": 0,
@@ -187,6 +183,11 @@ def summarize_llama_quantable_params(base_dir, layers, fp, llama2=True):
                 "quant_count": param_count if data["quant"] else 0,
             }
             dikts.append(dikt)
+    return dikts
+
+
+def summarize_llama_quantable_params(base_dir, layers, fp, llama2=True):
+    dikts = get_llama_quantable_params(get_reader(base_dir), layers, llama2=llama2)
     df = pd.DataFrame(dikts)
     df.to_csv(fp, index=False)
 
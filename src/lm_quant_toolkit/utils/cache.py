@@ -0,0 +1,120 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+CACHE_DIR_ENV = "LM_QUANT_TOOLKIT_CACHE"
+
+
+def get_cache_dir(name, cache_dir=None):
+    """Return (and create) the directory of cache `name`.
+
+    The root defaults to `~/.cache/lm_quant_toolkit` and can be overridden
+    with the `LM_QUANT_TOOLKIT_CACHE` environment variable.
+    """
+    if cache_dir is None:
+        root = os.environ.get(
+            CACHE_DIR_ENV,
+            os.path.join(os.path.expanduser("~"), ".cache", "lm_quant_toolkit"),
+        )
+        cache_dir = os.path.join(root, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def cache_key(*parts):
+    """Content address of the json-serializable `parts`."""
+    blob = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+def file_digest(fp, chunk_size=1 << 24):
+    h = hashlib.sha256()
+    with open(fp, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_path(fp):
+    """Yield a unique temporary path that replaces `fp` when the block exits.
+
+    The temporary file lives next to `fp`, so concurrent writers of the same
+    entry never share it and readers only ever see complete files.
+    """
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(fp) or ".", prefix=f".{os.path.basename(fp)}."
+    )
+    os.close(fd)
+    os.chmod(tmp, 0o644)
+    try:
+        yield tmp
+        os.replace(tmp, fp)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def save_tensor(fp, tensor):
+    """Save `tensor` as a .npy file atomically, returning its dtype name.
+
+    Dtypes numpy doesn't know (bfloat16) are stored as raw 16-bit integers
+    and restored by `load_tensor`.
+    """
+    tensor = tensor.detach().cpu().contiguous()
+    dtype = str(tensor.dtype).replace("torch.", "")
+    if tensor.dtype == torch.bfloat16:
+        tensor = tensor.view(torch.int16)
+    with atomic_path(fp) as tmp, open(tmp, "wb") as fh:
+        np.save(fh, tensor.numpy())
+    return dtype
+
+
+def load_tensor(fp, dtype=None):
+    """Memory-map a .npy file written by `save_tensor` without copying it."""
+    # copy-on-write mapping keeps the array writable for torch.from_numpy
+    tensor = torch.from_numpy(np.load(fp, mmap_mode="c"))
+    if dtype == "bfloat16":
+        tensor = tensor.view(torch.bfloat16)
+    return tensor
+
+
+def touch(path):
+    os.utime(path, (time.time(), time.time()))
+
+
+def get_dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            size += os.path.getsize(os.path.join(root, f))
+    return size
+
+
+def evict_lru(cache_dir, max_bytes, keep=()):
+    """Remove least recently used entries of `cache_dir` above `max_bytes`."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        entries.append((os.path.getmtime(path), path, get_dir_size(path)))
+    total = sum(entry[2] for entry in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        total -= size
+    return total
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import random
+
+import numpy as np
+import torch
+from datasets import load_dataset
+
+from lm_quant_toolkit.utils.cache import (
+    cache_key,
+    get_cache_dir,
+    load_tensor,
+    save_tensor,
+)
+
+C4_TRAIN_SHARD = "en/c4-train.00001-of-01024.json.gz"
+C4_VALIDATION_SHARD = "en/c4-validation.00000-of-00008.json.gz"
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of the vocabulary and special tokens of `tokenizer`."""
+    h = hashlib.sha256()
+    h.update(type(tokenizer).__name__.encode("utf-8"))
+    vocab = sorted(tokenizer.get_vocab().items(), key=lambda kv: kv[1])
+    h.update(json.dumps(vocab, ensure_ascii=False).encode("utf-8"))
+    h.update(json.dumps(tokenizer.all_special_tokens).encode("utf-8"))
+    h.update(str(getattr(tokenizer, "add_bos_token", None)).encode("utf-8"))
+    h.update(str(getattr(tokenizer, "add_eos_token", None)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def load_calib_texts(data, split="train", n_docs=None):
+    if data == "pileval":
+        dataset = load_dataset("mit-han-lab/pile-val-backup", split="validation")
+    elif data == "wikitext":
+        dataset = load_dataset("wikitext", "wikitext-2-raw-v1", split="validation")
+    elif data == "bos":
+        dataset = load_dataset("schnell18/branch-of-science", split="train")
+    elif data == "c4":
+        dataset = load_dataset(
+            "allenai/c4",
+            data_files={"validation": C4_VALIDATION_SHARD},
+            split="validation",
+            download_mode="reuse_dataset_if_exists",
+        )
+    elif data == "c4-train":
+        dataset = load_dataset(
+            "allenai/c4",
+            data_files=C4_TRAIN_SHARD,
+            split="train" if n_docs is None else f"train[:{n_docs}]",
+        )
+    else:
+        dataset = load_dataset(data, split=split)
+    return dataset
+
+
+def _batch_encode(tokenizer, texts):
+    return tokenizer(texts, return_attention_mask=False)["input_ids"]
+
+
+def _pack_contiguous(
+    tokenizer, dataset, text_column, n_samples, block_size, seed, max_line_tokens
+):
+    # shuffled lines no longer than `max_line_tokens`, concatenated and cut
+    # into consecutive blocks
+    dataset = dataset.shuffle(seed=seed)
+    lines = []
+    batch_size = max(64, n_samples)
+    for start in range(0, len(dataset), batch_size):
+        texts = dataset[start : start + batch_size][text_column]
+        for ids in _batch_encode(tokenizer, [t.strip() for t in texts]):
+            if 0 < len(ids) <= max_line_tokens:
+                lines.append(ids)
+                if len(lines) == n_samples:
+                    break
+        if len(lines) == n_samples:
+            break
+    stream = np.concatenate([np.asarray(ids, dtype=np.int32) for ids in lines])
+    n_split = len(stream) // block_size
+    return stream[: n_split * block_size].reshape(n_split, block_size)
+
+
+def _pack_random(tokenizer, dataset, text_column, n_samples, block_size, seed):
+    # `n_samples` random windows over the concatenation of the documents
+    stream = np.concatenate(
+        [
+            np.asarray(ids, dtype=np.int32)
+            for ids in _batch_encode(tokenizer, dataset[:][text_column])
+        ]
+    )
+    rng = random.Random(seed)
+    starts = [rng.randint(0, len(stream) - block_size - 1) for _ in range(n_samples)]
+    return np.stack([stream[i : i + block_size] for i in starts])
+
+
+def get_calib_blocks(
+    tokenizer,
+    data="pileval",
+    split="train",
+    n_samples=128,
+    block_size=512,
+    seed=42,
+    sampling="contiguous",
+    text_column="text",
+    max_line_tokens=512,
+    cache_dir=None,
+):
+    """Return the tokenized calibration blocks as an int32 [n, block_size] tensor.
+
+    `sampling="contiguous"` shuffles the dataset with `seed` and cuts the
+    first `n_samples` short lines into consecutive blocks. `sampling="random"`
+    takes `n_samples` random windows over the first `n_samples` documents.
+    Blocks are tokenized once per (tokenizer, dataset, sampling parameters)
+    and memory-mapped from the calibration cache afterwards.
+    """
+    key = cache_key(
+        tokenizer_fingerprint(tokenizer),
+        data,
+        split,
+        text_column,
+        n_samples,
+        block_size,
+        seed,
+        sampling,
+        max_line_tokens if sampling == "contiguous" else None,
+    )
+    fp = os.path.join(get_cache_dir("calibration", cache_dir), f"{key}.npy")
+    if os.path.exists(fp):
+        return load_tensor(fp)
+
+    if sampling == "contiguous":
+        dataset = load_calib_texts(data, split)
+        blocks = _pack_contiguous(
+            tokenizer,
+            dataset,
+            text_column,
+            n_samples,
+            block_size,
+            seed,
+            max_line_tokens,
+        )
+    elif sampling == "random":
+        dataset = load_calib_texts(data, split, n_docs=n_samples)
+        blocks = _pack_random(
+            tokenizer, dataset, text_column, n_samples, block_size, seed
+        )
+    else:
+        raise ValueError(f"Unsupported sampling: {sampling}")
+    save_tensor(fp, torch.from_numpy(blocks))
+    return load_tensor(fp)
+
+
+def iter_calib_examples(blocks):
+    """Yield `{"input_ids", "attention_mask"}` dicts of shape [1, block_size]."""
+    for block in blocks:
+        input_ids = block.long().unsqueeze(0)
+        yield {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
@@ -1,21 +1,122 @@
+import functools
 import json
 import os
+import struct
+from collections import OrderedDict, defaultdict
 
 from safetensors import safe_open
 
 
-def get_tensor(matrix_name, base_dir, index_json="model.safetensors.index.json"):
-    fp = os.path.join(base_dir, index_json)
-    with open(fp, "r") as fh:
-        index = json.load(fh)
+class ShardedCheckpointReader:
+    """Read tensors from a (possibly sharded) safetensors checkpoint.
+
+    The index is parsed once per reader and up to `max_open` shard handles
+    are kept open in least-recently-used order, so repeated lookups neither
+    re-parse JSON nor re-open files.
+    """
+
+    def __init__(
+        self,
+        base_dir,
+        index_json="model.safetensors.index.json",
+        model_file="model.safetensors",
+        max_open=4,
+    ):
+        self.base_dir = base_dir
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._offsets = {}
+        fp = os.path.join(base_dir, index_json)
+        if os.path.exists(fp):
+            with open(fp, "r") as fh:
+                self.weight_map = json.load(fh)["weight_map"]
+        else:
+            # single-file checkpoint without index
+            self.weight_map = {
+                key: model_file for key in self._read_header(model_file)
+            }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._handles.clear()
+
+    def keys(self):
+        return self.weight_map.keys()
+
+    def get_tensor(self, matrix_name):
+        return self._open(self._get_shard(matrix_name)).get_tensor(matrix_name)
+
+    def get_shape(self, matrix_name):
+        """Return the shape of a tensor from the shard header without loading it."""
+        st_file = self._get_shard(matrix_name)
+        return self._get_offsets(st_file)[matrix_name][1]
+
+    def order(self, matrix_names):
+        """Sort tensor names by shard and by their offset within the shard."""
+        return sorted(
+            matrix_names,
+            key=lambda name: (
+                self._get_shard(name),
+                self._get_offsets(self._get_shard(name))[name][0],
+            ),
+        )
+
+    def iter_tensors(self, matrix_names):
+        """Yield (name, tensor) pairs grouped by shard in on-disk order."""
+        by_shard = defaultdict(list)
+        for name in self.order(matrix_names):
+            by_shard[self._get_shard(name)].append(name)
+        for st_file, names in by_shard.items():
+            handle = self._open(st_file)
+            for name in names:
+                yield name, handle.get_tensor(name)
+
+    def _get_shard(self, matrix_name):
         try:
-            st_file = index["weight_map"][matrix_name]
-            mp = os.path.join(base_dir, st_file)
-            with safe_open(mp, framework="pt", device="cpu") as f:
-                return f.get_tensor(matrix_name)
-        except Exception:
+            return self.weight_map[matrix_name]
+        except KeyError:
             raise ValueError(f"Invalid key {matrix_name}")
 
+    def _open(self, st_file):
+        handle = self._handles.pop(st_file, None)
+        if handle is None:
+            mp = os.path.join(self.base_dir, st_file)
+            handle = safe_open(mp, framework="pt", device="cpu")
+            while len(self._handles) >= self.max_open:
+                self._handles.popitem(last=False)
+        self._handles[st_file] = handle
+        return handle
+
+    def _get_offsets(self, st_file):
+        if st_file not in self._offsets:
+            self._offsets[st_file] = {
+                key: (val["data_offsets"][0], val["shape"])
+                for key, val in self._read_header(st_file).items()
+            }
+        return self._offsets[st_file]
+
+    def _read_header(self, st_file):
+        # safetensors layout: 8-byte little-endian header size + JSON header
+        with open(os.path.join(self.base_dir, st_file), "rb") as fh:
+            (header_size,) = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_size))
+        header.pop("__metadata__", None)
+        return header
+
+
+@functools.lru_cache(maxsize=4)
+def get_reader(base_dir, index_json="model.safetensors.index.json"):
+    return ShardedCheckpointReader(base_dir, index_json=index_json)
+
+
+def get_tensor(matrix_name, base_dir, index_json="model.safetensors.index.json"):
+    return get_reader(base_dir, index_json).get_tensor(matrix_name)
+
 
 def get_tensor2(matrix_name, st_file_fp):
     try:
@@ -0,0 +1,149 @@
+import math
+
+import torch
+
+
+class AbsQuantileSketch:
+    """Streaming quantile sketch of |x| with bounded relative error.
+
+    Absolute values are counted in logarithmic buckets (gamma^(i-1), gamma^i]
+    with gamma = (1 + alpha) / (1 - alpha), so every reported quantile is
+    within a relative error of `alpha` of a true order statistic. The number
+    of buckets only depends on the dynamic range of the data, not its size.
+    """
+
+    def __init__(self, alpha=0.001):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.zeros = 0
+        self.offset = 0
+        self.counts = None
+
+    def update(self, x):
+        n = x.numel()
+        x = x[x > 0]
+        self.count += n
+        self.zeros += n - x.numel()
+        if x.numel() == 0:
+            return
+        idx = torch.ceil(torch.log(x) / self._log_gamma).long()
+        self._grow(int(idx.min()), int(idx.max()))
+        self.counts += torch.bincount(idx - self.offset, minlength=len(self.counts))
+
+    def quantile(self, q):
+        if self.count == 0:
+            return math.nan
+        rank = math.floor(q * (self.count - 1))
+        if rank < self.zeros:
+            return 0.0
+        cum = torch.cumsum(self.counts, dim=0)
+        i = int(torch.searchsorted(cum, rank - self.zeros, right=True))
+        return 2 * self.gamma ** (i + self.offset) / (self.gamma + 1)
+
+    def _grow(self, lo, hi):
+        if self.counts is None:
+            self.offset = lo
+            self.counts = torch.zeros(hi - lo + 1, dtype=torch.int64)
+            return
+        cur_hi = self.offset + len(self.counts) - 1
+        new_lo, new_hi = min(lo, self.offset), max(hi, cur_hi)
+        if new_lo < self.offset or new_hi > cur_hi:
+            counts = torch.zeros(new_hi - new_lo + 1, dtype=torch.int64)
+            start = self.offset - new_lo
+            counts[start : start + len(self.counts)] = self.counts
+            self.counts, self.offset = counts, new_lo
+
+
+class StreamingStats:
+    """Single-pass moments, abs-min/max and |x| quantiles over tensor chunks.
+
+    Central moments of each chunk are merged with the pairwise update of
+    Pébay (2008), which stays accurate for long streams. NaNs are skipped
+    like `nan_policy="omit"` in scipy.
+    """
+
+    def __init__(self, alpha=0.001):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.m3 = 0.0
+        self.m4 = 0.0
+        self.abs_min = math.inf
+        self.abs_max = 0.0
+        self.sketch = AbsQuantileSketch(alpha)
+
+    def update(self, x):
+        x = x.reshape(-1).to(torch.float64)
+        x = x[~torch.isnan(x)]
+        nb = x.numel()
+        if nb == 0:
+            return
+        mb = float(x.mean())
+        d = x - mb
+        d2 = d * d
+        m2b = float(d2.sum())
+        m3b = float((d2 * d).sum())
+        m4b = float((d2 * d2).sum())
+        del d, d2
+        abs_x = x.abs_()
+        self.abs_min = min(self.abs_min, float(abs_x.min()))
+        self.abs_max = max(self.abs_max, float(abs_x.max()))
+        self.sketch.update(abs_x)
+
+        na = self.n
+        n = na + nb
+        delta = mb - self.mean
+        self.m4 += (
+            m4b
+            + delta**4 * na * nb * (na * na - na * nb + nb * nb) / n**3
+            + 6 * delta**2 * (na * na * m2b + nb * nb * self.m2) / n**2
+            + 4 * delta * (na * m3b - nb * self.m3) / n
+        )
+        self.m3 += (
+            m3b
+            + delta**3 * na * nb * (na - nb) / n**2
+            + 3 * delta * (na * m2b - nb * self.m2) / n
+        )
+        self.m2 += m2b + delta**2 * na * nb / n
+        self.mean += delta * nb / n
+        self.n = n
+
+    @property
+    def variance(self):
+        return self.m2 / self.n if self.n else math.nan
+
+    @property
+    def skewness(self):
+        if self.m2 == 0:
+            return math.nan
+        return math.sqrt(self.n) * self.m3 / self.m2**1.5
+
+    @property
+    def kurtosis(self):
+        """Pearson kurtosis, same as scipy `kurtosis(fisher=False, bias=True)`."""
+        if self.m2 == 0:
+            return math.nan
+        return self.n * self.m4 / self.m2**2
+
+    def abs_percentile(self, q):
+        """Approximate percentile `q` (0-100) of |x|; 0 and 100 are exact."""
+        if q <= 0:
+            return self.abs_min
+        if q >= 100:
+            return self.abs_max
+        return min(self.sketch.quantile(q / 100), self.abs_max)
+
+
+def summarize_tensor(w, chunk_size=1 << 22, alpha=0.001):
+    """Compute streaming statistics of `w` in chunks of `chunk_size` elements.
+
+    Only one float64 chunk is materialized at a time, so the memory needed
+    is fixed regardless of the size or dtype (fp16/bf16) of `w`.
+    """
+    stats = StreamingStats(alpha)
+    flat = w.reshape(-1)
+    for i in range(0, flat.numel(), chunk_size):
+        stats.update(flat[i : i + chunk_size])
+    return stats